@@ -0,0 +1,269 @@
+"""In-process benchmarks of the request hot path.
+
+Raw HTTP requests are fed to the protocol with a fake transport, so only Roll
+(parsing, routing, hooks, response writing) is measured, without any network
+nor client overhead.
+
+    python benchmarks/hotpath.py
+    python benchmarks/hotpath.py minimal full --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from roll import Roll  # noqa: E402
+
+app = Roll()
+
+
+@app.route("/hello/minimal")
+async def minimal(request, response):
+    response.json = {"message": "Hello, World!"}
+
+
+@app.route("/hello/with/{parameter}")
+async def parameter(request, response, parameter):
+    response.json = {"parameter": parameter}
+
+
+@app.route("/hello/cookie")
+async def cookie(request, response):
+    response.json = {"cookie": request.cookies["test"]}
+    response.cookies.set(name="bench", value="value")
+
+
+@app.route("/hello/query")
+async def query(request, response):
+    response.json = {"query": request.query.get("query")}
+
+
+@app.route("/hello/full/with/{one}/and/{two}")
+async def full(request, response, one, two):
+    response.json = {
+        "parameters": f"{one} and {two}",
+        "query": request.query.get("query"),
+        "cookie": request.cookies["test"],
+    }
+    response.cookies.set(name="bench", value="value")
+
+
+@app.route("/hello/json", methods=["POST"])
+async def post_json(request, response):
+    response.json = {"received": len(request.json["items"])}
+
+
+@app.route("/hello/multipart", methods=["POST"])
+async def multipart(request, response):
+    response.json = {"name": request.form.get("name"), "files": len(request.files)}
+
+
+@app.route("/hello/chunked")
+async def chunked(request, response):
+    async def chunks():
+        for i in range(10):
+            yield b"chunk %d" % i
+
+    response.body = chunks()
+
+
+def compiled():
+    """Return the Roll modules compiled with Cython."""
+    modules = ("roll", "roll.http", "roll.io")
+    return [
+        name
+        for name in modules
+        if not importlib.import_module(name).__file__.endswith(".py")
+    ]
+
+
+def build(method, path, headers=(), body=b""):
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost", *headers]
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    return "\r\n".join(lines).encode() + b"\r\n\r\n" + body
+
+
+JSON_BODY = json.dumps({"items": list(range(100))}).encode()
+MULTIPART_TYPE = "multipart/form-data; boundary=BenchBoundary"
+MULTIPART_BODY = (
+    b"--BenchBoundary\r\n"
+    b'Content-Disposition: form-data; name="name"\r\n\r\n'
+    b"bench\r\n"
+    b"--BenchBoundary\r\n"
+    b'Content-Disposition: form-data; name="file"; filename="file.txt"\r\n'
+    b"Content-Type: text/plain\r\n\r\n" + b"x" * 1024 + b"\r\n"
+    b"--BenchBoundary--\r\n"
+)
+SCENARIOS = {
+    "minimal": build("GET", "/hello/minimal"),
+    "parameter": build("GET", "/hello/with/foobar"),
+    "cookie": build("GET", "/hello/cookie", ["Cookie: test=bench"]),
+    "query": build("GET", "/hello/query?query=foobar"),
+    "full": build(
+        "GET", "/hello/full/with/foo/and/bar?query=foobar", ["Cookie: test=bench"]
+    ),
+    "post_json": build(
+        "POST", "/hello/json", ["Content-Type: application/json"], JSON_BODY
+    ),
+    "multipart": build(
+        "POST", "/hello/multipart", [f"Content-Type: {MULTIPART_TYPE}"], MULTIPART_BODY
+    ),
+    "chunked": build("GET", "/hello/chunked"),
+}
+
+
+class Transport:
+    """Only count the written bytes."""
+
+    def __init__(self):
+        self.written = 0
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+    def write(self, data):
+        self.written += len(data)
+
+    def close(self):
+        self.closing = True
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 0) if name == "peername" else default
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+async def call(data: bytes):
+    protocol = app.factory()
+    transport = Transport()
+    protocol.connection_made(transport)
+    protocol.data_received(data)
+    await protocol.task
+    protocol.connection_lost(None)
+    return protocol
+
+
+async def measure(data: bytes, number: int):
+    perf_counter_ns = time.perf_counter_ns
+    durations = []
+    for _ in range(number):
+        start = perf_counter_ns()
+        await call(data)
+        durations.append(perf_counter_ns() - start)
+    return durations
+
+
+async def allocations(data: bytes, number: int):
+    """Return the median of memory allocated per request (peak, retained)."""
+    peaks, retained = [], []
+    for _ in range(number):
+        tracemalloc.start()
+        protocol = await call(data)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del protocol
+        peaks.append(peak)
+        retained.append(current)
+    return statistics.median(peaks), statistics.median(retained)
+
+
+async def run(name: str, number: int, warmup: int):
+    data = SCENARIOS[name]
+    protocol = await call(data)
+    assert protocol.response.status == 200, (name, protocol.response.body)
+    await measure(data, warmup)
+    durations = await measure(data, number)
+    durations.sort()
+    peak, retained = await allocations(data, min(number, 500))
+    return {
+        "ops": round(number / (sum(durations) / 1e9)),
+        "p50": durations[len(durations) // 2] / 1000,
+        "p99": durations[int(len(durations) * 0.99)] / 1000,
+        "alloc_peak": peak,
+        "alloc_retained": retained,
+    }
+
+
+def compare(results: dict, baseline: dict):
+    print()
+    print(f"{'scenario':<12}{'ops/sec':>20}{'p50 (µs)':>20}{'p99 (µs)':>20}")
+    for name, result in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        cells = []
+        for key in ("ops", "p50", "p99"):
+            delta = (result[key] - before[key]) / before[key] * 100
+            cells.append(f"{before[key]:>8.1f} {delta:>+7.1f}%")
+        print(f"{name:<12}" + "".join(f"{cell:>20}" for cell in cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"default: all ({', '.join(SCENARIOS)})"
+    )
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--uvloop", action="store_true")
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    parser.add_argument("--compare", type=Path, help="JSON results to compare with")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+    if args.uvloop:
+        import uvloop
+
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    app.loop = loop
+    loop.run_until_complete(app.startup())
+    results = {}
+    print(f"Compiled modules: {', '.join(compiled()) or 'none'}")
+    print(
+        f"{'scenario':<12}{'ops/sec':>10}{'p50 (µs)':>10}{'p99 (µs)':>10}"
+        f"{'peak (B)':>10}{'kept (B)':>10}"
+    )
+    for name in args.scenarios or SCENARIOS:
+        result = results[name] = loop.run_until_complete(
+            run(name, args.number, args.warmup)
+        )
+        print(
+            f"{name:<12}{result['ops']:>10}{result['p50']:>10.1f}"
+            f"{result['p99']:>10.1f}{result['alloc_peak']:>10.0f}"
+            f"{result['alloc_retained']:>10.0f}"
+        )
+    loop.run_until_complete(app.shutdown())
+    loop.close()
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+    if args.output:
+        output = {
+            "python": platform.python_version(),
+            "loop": "uvloop" if args.uvloop else "asyncio",
+            "compiled": compiled(),
+            "number": args.number,
+            "results": results,
+        }
+        args.output.write_text(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
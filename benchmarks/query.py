@@ -0,0 +1,43 @@
+"""Compare `Query.parse` with `urllib.parse.parse_qs`.
+
+python benchmarks/query.py
+"""
+
+import sys
+import timeit
+from pathlib import Path
+from urllib.parse import parse_qs
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from roll import Query  # noqa: E402
+
+QUERY_STRINGS = {
+    "empty": "",
+    "single": "query=foobar",
+    "several": "page=2&per_page=50&sort=name&order=desc&q=foo",
+    "quoted": "q=caf%C3%A9+au+lait&tags=a%2Cb&redirect=%2Fhome%3Fx%3D1",
+    "repeated": "&".join(f"id={i}" for i in range(50)),
+}
+
+
+def main():
+    number = 100000
+    print(f"{'query':<10}{'parse_qs (µs)':>15}{'Query.parse (µs)':>18}{'speedup':>10}")
+    for name, query_string in QUERY_STRINGS.items():
+        assert Query.parse(query_string) == parse_qs(
+            query_string, keep_blank_values=True
+        )
+        before = timeit.timeit(
+            lambda: Query(parse_qs(query_string, keep_blank_values=True)),
+            number=number,
+        )
+        after = timeit.timeit(lambda: Query.parse(query_string), number=number)
+        print(
+            f"{name:<10}{before / number * 1e6:>15.2f}"
+            f"{after / number * 1e6:>18.2f}{before / after:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
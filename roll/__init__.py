@@ -9,13 +9,23 @@ please submit an issue (or even better a pull-request with at least
 a test failing): https://github.com/pyrates/roll/issues/new
 """
 
+import asyncio
 import inspect
 from collections import defaultdict, namedtuple
 from http import HTTPStatus
 
 from autoroutes import Routes
 
-from .http import Cookies, Files, Form, HttpError, HTTPProtocol, Query
+from .http import (
+    ConcurrencyLimit,
+    Cookies,
+    Files,
+    Form,
+    HttpError,
+    HTTPProtocol,
+    Query,
+    current_task,
+)
 from .io import Request, Response
 from .websocket import ConnectionClosed  # noqa. Exposed for convenience.
 from .websocket import WSProtocol
@@ -50,11 +60,18 @@ class Roll(dict):
     Request = Request
     Response = Response
     Cookies = Cookies
+    # Maximum seconds for handling a request, can be overridden per route.
+    TIMEOUT = None
+    # Header the client can use to send its own time budget, in seconds.
+    DEADLINE_HEADER = None
 
     def __init__(self):
         self.routes = self.Routes()
         self.hooks = defaultdict(list)
         self._urls = {}
+        self.limits = {}
+        self.connections = set()
+        self.closing = False
 
     async def startup(self):
         await self.hook("startup")
@@ -62,9 +79,72 @@ class Roll(dict):
     async def shutdown(self):
         await self.hook("shutdown")
 
+    async def drain(self, timeout: float = 30):
+        """Close keep-alive connections and wait for requests in flight.
+
+        Websockets are closed (with the `1001` code) and streamed bodies with
+        a `close()` method (eg. SSE streams) are ended, so only the ordinary
+        requests are waited for. Requests still running after `timeout`
+        seconds are cancelled (their streamed body is cut, without its last
+        chunk).
+        Returns the count of drained and killed requests.
+        """
+        self.closing = True
+        deadline = self.loop.time() + timeout
+        for protocol in list(self.connections):
+            if protocol.task is None or protocol.task.done():
+                continue
+            if protocol.websocket is not None:
+                self.loop.create_task(
+                    protocol.websocket.close(1001, "Server shutting down.")
+                )
+            elif protocol.is_chunked:
+                close = getattr(protocol.response.body, "close", None)
+                if close is not None:
+                    # Eg. a SSE stream, waiting for its next event.
+                    close()
+        seen = set()
+        receiving = {}  # Protocol => its previous task.
+        while True:
+            for protocol, previous in receiving.items():
+                if protocol.task is not previous:
+                    # Its new task may already be done (and closed).
+                    seen.add(protocol.task)
+            tasks = set()
+            for protocol in list(self.connections):
+                if protocol.task is not None and not protocol.task.done():
+                    tasks.add(protocol.task)
+                elif protocol.receiving:
+                    # Headers not fully received yet: the request will be
+                    # handled, then the connection closed.
+                    receiving[protocol] = protocol.task
+                else:
+                    # Idle keep-alive connection.
+                    protocol.transport.close()
+            seen |= tasks
+            receiving = {p: t for p, t in receiving.items() if p.receiving}
+            remaining = deadline - self.loop.time()
+            if not tasks and not receiving or remaining <= 0:
+                break
+            if receiving:
+                # Check again soon for their task.
+                remaining = min(remaining, 0.1)
+            if tasks:
+                await asyncio.wait(tasks, timeout=remaining)
+            else:
+                await asyncio.sleep(remaining)
+        for protocol in list(self.connections):
+            if protocol.task in tasks:
+                protocol.task.cancel()
+            protocol.transport.close()
+        return len(seen) - len(tasks), len(tasks)
+
     async def __call__(self, request: Request, response: Response):
         payload = request.route.payload
         try:
+            timeout = payload.get("timeout", self.TIMEOUT) if payload else self.TIMEOUT
+            if timeout is not None or self.DEADLINE_HEADER:
+                self.set_deadline(request, timeout)
             if not await self.hook("headers", request, response):
                 if not payload:
                     raise HttpError(HTTPStatus.NOT_FOUND, request.path)
@@ -74,8 +154,13 @@ class Roll(dict):
                 if not payload.get("lazy_body"):
                     await request.load_body()
                 if not await self.hook("request", request, response):
-                    handler = payload[request.method]
-                    await handler(request, response, **request.route.vars)
+                    if request.deadline is None:
+                        await self.call_handler(request, response, payload)
+                    else:
+                        # Waiting in the queue counts in the deadline.
+                        await self.wait_for_deadline(
+                            request, self.call_handler(request, response, payload)
+                        )
         except Exception as error:
             await self.on_error(request, response, error)
         try:
@@ -85,6 +170,62 @@ class Roll(dict):
             await self.on_error(request, response, error)
         return response
 
+    async def call_handler(self, request: Request, response: Response, payload):
+        limit = payload.get("_limit")
+        if limit is not None:
+            await limit.acquire(
+                payload.get("priority", 0), payload.get("queue_timeout")
+            )
+        try:
+            await payload[request.method](request, response, **request.route.vars)
+        finally:
+            if limit is not None:
+                limit.release()
+
+    def set_deadline(self, request: Request, timeout: float = None):
+        if self.DEADLINE_HEADER:
+            budget = request.headers.get(self.DEADLINE_HEADER.upper())
+            if budget:
+                try:
+                    budget = float(budget)
+                except ValueError:
+                    raise HttpError(
+                        HTTPStatus.BAD_REQUEST, f"Invalid {self.DEADLINE_HEADER}"
+                    )
+                if timeout is None or budget < timeout:
+                    timeout = budget
+        if timeout is not None:
+            request.deadline = self.loop.time() + timeout
+
+    async def wait_for_deadline(self, request: Request, coroutine):
+        """Await `coroutine` in the current task, cancelling it at the
+        request deadline (no task is created)."""
+        if hasattr(asyncio, "timeout_at"):  # Python 3.11+
+            try:
+                async with asyncio.timeout_at(request.deadline):
+                    return await coroutine
+            except asyncio.TimeoutError as error:
+                raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, context=error)
+        task = current_task(self.loop)
+        expired = False
+
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        handle = self.loop.call_at(request.deadline, expire)
+        try:
+            return await coroutine
+        except asyncio.CancelledError:
+            if not expired:
+                raise
+            raise HttpError(
+                HTTPStatus.GATEWAY_TIMEOUT, context=asyncio.TimeoutError()
+            )
+        finally:
+            handle.cancel()
+
     async def on_error(self, request: Request, response: Response, error):
         if not isinstance(error, HttpError):
             error = HttpError(HTTPStatus.INTERNAL_SERVER_ERROR, context=error)
@@ -118,6 +259,12 @@ class Roll(dict):
         # Computed at load time for perf.
         extras["protocol"] = protocol
         extras["_protocol_class"] = protocol_class
+        extras["_path"] = path
+        limit = extras.get("max_concurrency")
+        if limit:
+            if not isinstance(limit, ConcurrencyLimit):
+                limit = ConcurrencyLimit(limit, extras.get("queue_size"))
+            extras["_limit"] = self.limits[path] = limit
 
         def add_route(view):
             nonlocal methods
@@ -0,0 +1,267 @@
+"""HTTP load generator, to benchmark an app end to end on localhost.
+
+Each connection is kept alive and sends its next request as soon as a response
+is received (or keeps `pipeline` requests in flight).
+
+    python -m roll.bench http://127.0.0.1:3579/hello -c 50 -d 10
+    python -m roll.bench --app mypackage.core:app --scenario scenario.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from httptools import HttpResponseParser
+
+from .metrics import Histogram
+
+
+def hdr_bounds(lowest=1e-6, highest=60, precision=0.01):
+    """Return log-linear buckets bounds from `lowest` to `highest` seconds,
+    each bucket being at most `precision` (relative) large."""
+    count = math.ceil(math.log(highest / lowest) / math.log1p(precision))
+    return [lowest * (1 + precision) ** i for i in range(count + 1)]
+
+
+def load_scenario(path: str):
+    """Load requests from a JSON file: a list of objects with `method`,
+    `path`, `headers` and `body` keys (all optional but `path`)."""
+    with open(path) as f:
+        return [
+            (r.get("method", "GET"), r["path"], r.get("headers", {}), r.get("body"))
+            for r in json.load(f)
+        ]
+
+
+def encode_request(host: str, method: str, path: str, headers=None, body=None):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+        headers = {"Content-Type": "application/json", **(headers or {})}
+    if isinstance(body, str):
+        body = body.encode()
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}"]
+    lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+    if body:
+        lines.append(f"Content-Length: {len(body)}")
+    return "\r\n".join(lines).encode() + b"\r\n\r\n" + (body or b"")
+
+
+class Results:
+    def __init__(self):
+        self.histogram = Histogram(hdr_bounds())
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0
+
+    @property
+    def count(self):
+        return self.histogram.count
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0
+
+    def report(self):
+        lines = [
+            f"{self.count} requests in {self.elapsed:.2f}s, "
+            f"{self.bytes / 2 ** 20:.2f}MB read, {self.errors} errors",
+            f"Requests/sec: {self.throughput:.2f}",
+            "Statuses: "
+            + ", ".join(f"{k}: {v}" for k, v in sorted(self.statuses.items())),
+            "Latency:",
+        ]
+        for q in (0.5, 0.75, 0.9, 0.99, 0.999, 0.9999, 1):
+            value = self.histogram.quantile(q)
+            if value is not None:
+                lines.append(f"  {q * 100:>7.3f}% {value * 1000:>10.3f}ms")
+        return "\n".join(lines)
+
+
+class Connection(asyncio.Protocol):
+    """Keep-alive connection, with up to `pipeline` requests in flight."""
+
+    def __init__(self, requests, results, pipeline, stop_at):
+        self.requests = requests
+        self.results = results
+        self.pipeline = pipeline
+        self.stop_at = stop_at
+        self.index = 0
+        self.sent = deque()  # Start times of the requests in flight.
+        self.parser = HttpResponseParser(self)
+        self.closed = asyncio.get_event_loop().create_future()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+        for _ in range(self.pipeline):
+            self.send()
+
+    def connection_lost(self, exc):
+        if self.sent:
+            # Requests in flight are lost.
+            self.results.errors += len(self.sent)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def send(self):
+        request = self.requests[self.index % len(self.requests)]
+        self.index += 1
+        self.sent.append(time.perf_counter())
+        self.transport.write(request)
+
+    def data_received(self, data: bytes):
+        self.results.bytes += len(data)
+        try:
+            self.parser.feed_data(data)
+        except Exception:
+            self.results.errors += 1
+            self.transport.close()
+
+    def on_message_complete(self):
+        now = time.perf_counter()
+        self.results.histogram.observe(now - self.sent.popleft())
+        status = self.parser.get_status_code()
+        self.results.statuses[status] = self.results.statuses.get(status, 0) + 1
+        if not self.parser.should_keep_alive():
+            self.transport.close()
+        elif now < self.stop_at:
+            self.send()
+        elif not self.sent:
+            self.transport.close()
+
+
+async def run(
+    url: str,
+    requests: list = None,
+    connections: int = 10,
+    duration: float = 10,
+    pipeline: int = 1,
+):
+    """Load `url` for `duration` seconds, and return the `Results`.
+
+    `requests` is a list of (method, path, headers, body) tuples, replayed in
+    a loop by each connection (default: `GET` the `url` path).
+    """
+    parsed = urlsplit(url)
+    host, port = parsed.hostname, parsed.port or 80
+    if not requests:
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        requests = [("GET", path, None, None)]
+    netloc = parsed.netloc
+    requests = [encode_request(netloc, *request) for request in requests]
+    loop = asyncio.get_event_loop()
+    results = Results()
+    start = time.perf_counter()
+    stop_at = start + duration
+
+    async def connect():
+        while time.perf_counter() < stop_at:
+            try:
+                _, connection = await loop.create_connection(
+                    lambda: Connection(requests, results, pipeline, stop_at), host, port
+                )
+            except OSError:
+                results.errors += 1
+                await asyncio.sleep(0.1)
+                continue
+            await connection.closed
+
+    await asyncio.gather(*(connect() for _ in range(connections)))
+    results.elapsed = time.perf_counter() - start
+    return results
+
+
+def start_app(path: str, workers: int = 1):
+    """Serve the app `path` (`module:attribute`) with `roll.serve` in a
+    subprocess, return the process and the URL."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "roll.serve",
+            path,
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--quiet",
+        ],
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m roll.bench", description=__doc__)
+    parser.add_argument("url", nargs="?", help="URL to load (or base URL)")
+    parser.add_argument("--app", help="app to serve with roll.serve, as module:attr")
+    parser.add_argument("--workers", type=int, default=1, help="workers for --app")
+    parser.add_argument("--scenario", help="JSON file of requests to replay")
+    parser.add_argument("-c", "--connections", type=int, default=10)
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument("-p", "--pipeline", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="output JSON")
+    args = parser.parse_args(argv)
+    if not args.url and not args.app:
+        parser.error("an URL or --app is required")
+    requests = load_scenario(args.scenario) if args.scenario else None
+    process = None
+    url = args.url
+    if args.app:
+        process, base = start_app(args.app, args.workers)
+        parsed = urlsplit(url or "/")
+        url = base + parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    try:
+        results = asyncio.get_event_loop().run_until_complete(
+            run(url, requests, args.connections, args.duration, args.pipeline)
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if args.json:
+        output = {
+            "requests": results.count,
+            "elapsed": results.elapsed,
+            "throughput": results.throughput,
+            "errors": results.errors,
+            "statuses": results.statuses,
+            "latency": {
+                str(q): results.histogram.quantile(q)
+                for q in (0.5, 0.75, 0.9, 0.99, 0.999, 1)
+            },
+        }
+        print(json.dumps(output, indent=2))
+    else:
+        print(results.report())
+    non_ok = sum(v for k, v in results.statuses.items() if k >= HTTPStatus.BAD_REQUEST)
+    return 1 if results.errors or non_ok else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
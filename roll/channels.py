@@ -0,0 +1,288 @@
+"""Publish/subscribe channels across the workers, through a local broker.
+
+Each worker connects to the broker on a unix socket, and tells it which
+channels it's subscribed to. A message published in a worker is delivered to
+its own subscribers, and sent once to the broker, which relays the same frame
+to the other workers subscribed to the channel. Frames are batched: all the
+frames sent during a loop iteration are written at once.
+
+    python -m roll.channels /run/roll.sock
+"""
+
+import asyncio
+import os
+import signal
+import struct
+import sys
+import time
+from collections import defaultdict
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+PUBLISH = 3
+BYTES = 0
+TEXT = 1
+# Operation, message kind, channel length, message length.
+HEADER = struct.Struct("!BBHI")
+
+
+def encode_frame(op: int, channel: str, message=b""):
+    kind = BYTES
+    if isinstance(message, str):
+        message = message.encode()
+        kind = TEXT
+    channel = channel.encode()
+    return HEADER.pack(op, kind, len(channel), len(message)) + channel + message
+
+
+def decode_frame(frame: bytes):
+    """Return the operation, channel and message of a `frame`."""
+    op, kind, channel_length, _ = HEADER.unpack_from(frame)
+    start = HEADER.size + channel_length
+    channel = frame[HEADER.size : start].decode()
+    message = frame[start:]
+    if kind == TEXT:
+        message = message.decode()
+    return op, channel, message
+
+
+class Link(asyncio.Protocol):
+    """Connection between a worker and the broker, sending and receiving
+    whole frames.
+
+    Frames sent during the same loop iteration are written at once. Published
+    frames are dropped (and counted) while the peer has more than `max_buffer`
+    bytes left to read, but never the subscriptions.
+    """
+
+    def __init__(self, on_frame, on_lost=None, max_buffer=2**24):
+        self.on_frame = on_frame
+        self.on_lost = on_lost
+        self.max_buffer = max_buffer
+        self.transport = None
+        self.buffer = bytearray()
+        self.outgoing = []
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.on_lost is not None:
+            self.on_lost(self)
+
+    def data_received(self, data: bytes):
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            _, _, channel_length, length = HEADER.unpack_from(buffer, offset)
+            end = offset + HEADER.size + channel_length + length
+            if len(buffer) < end:
+                break
+            self.on_frame(self, bytes(buffer[offset:end]))
+            offset = end
+        del buffer[:offset]
+
+    def send(self, frame: bytes):
+        if not self.outgoing:
+            asyncio.get_event_loop().call_soon(self.flush)
+        self.outgoing.append(frame)
+
+    def flush(self):
+        frames, self.outgoing = self.outgoing, []
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > self.max_buffer:
+            control = [frame for frame in frames if frame[0] != PUBLISH]
+            self.dropped += len(frames) - len(control)
+            frames = control
+        if frames:
+            self.transport.write(b"".join(frames))
+
+
+class Broker:
+    """Relay the frames published by a worker to the other workers subscribed
+    to their channel."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subscribers = defaultdict(set)  # Channel => links.
+        self.subscriptions = {}  # Link => channels.
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left by a previous broker.
+        self.server = await asyncio.get_event_loop().create_unix_server(
+            lambda: Link(self.on_frame, self.on_lost), self.path
+        )
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def on_frame(self, link, frame):
+        op, _, channel_length, _ = HEADER.unpack_from(frame)
+        channel = frame[HEADER.size : HEADER.size + channel_length]
+        if op == PUBLISH:
+            for subscriber in self.subscribers.get(channel, ()):
+                if subscriber is not link:
+                    subscriber.send(frame)
+        elif op == SUBSCRIBE:
+            self.subscribers[channel].add(link)
+            self.subscriptions.setdefault(link, set()).add(channel)
+        elif op == UNSUBSCRIBE:
+            self.unsubscribe(link, channel)
+
+    def unsubscribe(self, link, channel):
+        subscribers = self.subscribers.get(channel)
+        if subscribers is not None:
+            subscribers.discard(link)
+            if not subscribers:
+                del self.subscribers[channel]
+        self.subscriptions.get(link, set()).discard(channel)
+
+    def on_lost(self, link):
+        for channel in self.subscriptions.pop(link, ()):
+            self.unsubscribe(link, channel)
+
+    def run(self):
+        """Run the broker in the current process, until SIGTERM or SIGINT."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.start())
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, loop.stop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+
+def spawn_broker(path: str, timeout: float = 5, close_fds=()):
+    """Fork a process running a `Broker` on `path`, return its pid once it
+    listens. `close_fds` are closed in the broker process (eg. the parent
+    listening sockets)."""
+    if os.path.exists(path):
+        os.unlink(path)
+    pid = os.fork()
+    if pid:
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return pid
+    # Do not keep the parent file descriptors and signals handling.
+    signal.set_wakeup_fd(-1)
+    for fd in close_fds:
+        os.close(fd)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    status = 0
+    try:
+        Broker(path).run()
+    except BaseException:
+        import traceback
+
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+
+class Channels:
+    """Publish messages (`str` or `bytes`) to named channels.
+
+    Messages are delivered to the subscribers of the current process and,
+    when connected to the broker listening on `path` (default: the
+    `ROLL_BROKER` environment variable), to the ones of the other workers.
+    Without broker, messages are only delivered locally.
+    """
+
+    RECONNECT_DELAY = 1
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.subscribers = {}  # Channel => callbacks.
+        self.link = None
+        self.closed = False
+        self.dropped = 0
+
+    async def connect(self):
+        self.path = self.path or os.environ.get("ROLL_BROKER")
+        if not self.path or self.closed:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            _, link = await loop.create_unix_connection(
+                lambda: Link(self.on_frame, self.on_lost), self.path
+            )
+        except OSError:
+            loop.call_later(self.RECONNECT_DELAY, self.reconnect)
+            return
+        self.link = link
+        for channel in self.subscribers:
+            link.send(encode_frame(SUBSCRIBE, channel))
+
+    def reconnect(self):
+        asyncio.ensure_future(self.connect())
+
+    def on_lost(self, link):
+        self.link = None
+        if not self.closed:
+            asyncio.get_event_loop().call_later(self.RECONNECT_DELAY, self.reconnect)
+
+    def on_frame(self, link, frame):
+        op, channel, message = decode_frame(frame)
+        if op == PUBLISH:
+            self.deliver(channel, message)
+
+    def close(self):
+        self.closed = True
+        if self.link is not None:
+            self.link.flush()
+            self.link.transport.close()
+
+    def subscribe(self, channel: str, callback):
+        """Call `callback(channel, message)` for each message of `channel`."""
+        if channel not in self.subscribers:
+            self.subscribers[channel] = []
+            if self.link is not None:
+                self.link.send(encode_frame(SUBSCRIBE, channel))
+        self.subscribers[channel].append(callback)
+
+    def unsubscribe(self, channel: str, callback):
+        callbacks = self.subscribers.get(channel)
+        if not callbacks or callback not in callbacks:
+            return
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.subscribers[channel]
+            if self.link is not None:
+                self.link.send(encode_frame(UNSUBSCRIBE, channel))
+
+    def publish(self, channel: str, message):
+        self.deliver(channel, message)
+        if self.link is not None:
+            self.link.send(encode_frame(PUBLISH, channel, message))
+        elif self.path:
+            # Disconnected from the broker.
+            self.dropped += 1
+
+    def deliver(self, channel: str, message):
+        for callback in tuple(self.subscribers.get(channel, ())):
+            callback(channel, message)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.exit("Usage: python -m roll.channels PATH")
+    Broker(argv[0]).run()
+
+
+if __name__ == "__main__":
+    main()
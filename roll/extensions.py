@@ -1,14 +1,41 @@
 import asyncio
+import cProfile
+import hashlib
+import hmac
+import io
+import json
 import logging
+import math
+import marshal
 import mimetypes
+import pstats
+import queue
+import random
 import re
+import struct
 import sys
+import threading
+import time
+import weakref
+from array import array
 from http import HTTPStatus
 from pathlib import Path
 from textwrap import dedent
-from traceback import print_exc
+from traceback import format_stack, print_exc
+
+try:
+    import contextvars  # Python 3.7+
+except ImportError:
+    contextvars = None
+
+from websockets.exceptions import ConnectionClosed
+from websockets.framing import OP_BINARY, OP_PING, OP_TEXT, Frame
+from websockets.protocol import State
 
 from . import HTTP_METHODS, HttpError
+from .http import current_task
+from .channels import Channels
+from .metrics import LATENCY_BOUNDS, Histogram, Metrics, SharedMetrics
 
 
 def cors(app, origin="*", methods=None, headers=None, credentials=False):
@@ -28,18 +55,400 @@ def cors(app, origin="*", methods=None, headers=None, credentials=False):
             response.headers["Access-Control-Allow-Credentials"] = "true"
 
 
-def websockets_store(app):
+class WebsocketsStore(set):
+    """Connected websockets, with groups and broadcasting."""
+
+    def __init__(self, iterable=(), max_buffer=2**20, policy="close"):
+        if policy not in ("close", "drop"):
+            raise ValueError(f"Unknown slow consumers policy: {policy}")
+        super().__init__(iterable)
+        self.max_buffer = max_buffer
+        self.policy = policy
+        self.groups = {}  # Group name => websockets.
+        self.memberships = {}  # Websocket => group names.
+        self.tasks = set()  # Pending sends, see `broadcast`.
+        self.dropped = 0
+        self.closed = 0
+
+    def join(self, ws, *groups):
+        for group in groups:
+            self.groups.setdefault(group, set()).add(ws)
+        self.memberships.setdefault(ws, set()).update(groups)
+
+    def leave(self, ws, *groups):
+        """Remove `ws` from `groups`, or from all its groups if none given."""
+        memberships = self.memberships.get(ws, set())
+        for group in groups or list(memberships):
+            members = self.groups.get(group)
+            if members is not None:
+                members.discard(ws)
+                if not members:
+                    del self.groups[group]
+            memberships.discard(group)
+        if not memberships:
+            self.memberships.pop(ws, None)
+
+    def discard(self, ws):
+        super().discard(ws)
+        self.leave(ws)
+
+    def remove(self, ws):
+        super().remove(ws)
+        self.leave(ws)
+
+    def pop(self):
+        ws = super().pop()
+        self.leave(ws)
+        return ws
+
+    def clear(self):
+        super().clear()
+        self.groups.clear()
+        self.memberships.clear()
+
+    @staticmethod
+    def encode(message):
+        """Return the websocket frame of `message` (str or bytes), as bytes."""
+        if isinstance(message, str):
+            frame = Frame(True, OP_TEXT, message.encode())
+        else:
+            frame = Frame(True, OP_BINARY, bytes(message))
+        output = []
+        frame.write(output.append, mask=False)
+        return b"".join(output)
+
+    def broadcast(self, message, group=None, exclude=None):
+        """Send `message` to all the websockets (of `group` if given), but
+        `exclude`, without waiting for them. Returns the count of recipients.
+
+        The frame is encoded once, then written to each transport, unless the
+        connection has negociated an extension (eg. compression, whose state
+        is per connection) or is sending a fragmented message: it is then sent
+        with `ws.send`, in a task kept in `tasks` until done.
+        """
+        recipients = self if group is None else self.groups.get(group, ())
+        frame = None
+        sends = {}
+        sent = 0
+        for ws in list(recipients):
+            if ws.state is State.CLOSED:
+                self.discard(ws)
+                continue
+            if ws is exclude or ws.state is not State.OPEN:
+                continue
+            if ws.transport.get_write_buffer_size() > self.max_buffer:
+                if self.policy == "drop":
+                    self.dropped += 1
+                    continue
+                self.closed += 1
+                ws.fail_connection(1008, "Too slow")
+                continue
+            if ws.extensions or ws._fragmented_message_waiter is not None:
+                sends[ws] = ws.send(message)
+            else:
+                if frame is None:
+                    frame = self.encode(message)
+                ws.transport.write(frame)
+            sent += 1
+        if sends:
+            task = asyncio.ensure_future(self.send(sends))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return sent
+
+    async def send(self, sends):
+        results = await asyncio.gather(*sends.values(), return_exceptions=True)
+        errors = []
+        for ws, result in zip(sends, results):
+            if isinstance(result, ConnectionClosed):
+                self.discard(ws)
+            elif isinstance(result, Exception):
+                errors.append(result)
+        if errors:
+            raise errors[0]
+
+    def relay(self, channels, channel, group=None):
+        """Broadcast the messages published on `channel` (from any worker) to
+        the websockets (of `group` if given)."""
+
+        def broadcast(channel, message):
+            self.broadcast(message, group)
+
+        channels.subscribe(channel, broadcast)
+
+
+class KeepAlive:
+    """Ping all the websockets from one periodic task, instead of one task
+    and its timers per connection."""
+
+    def __init__(self, app, interval, timeout, jitter, batch):
+        self.app = app
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.batch = batch
+        self.connections = set()
+        self.pending = {}  # Websocket => (pong waiter, ping time).
+        self.task = None
+        self.pings = 0
+        self.closed = 0
+
+    async def run(self):
+        while True:
+            delay = self.interval * (1 + self.jitter * random.uniform(-1, 1))
+            await asyncio.sleep(delay)
+            await self.sweep()
+
+    async def sweep(self):
+        """Close the websockets which have not answered their last ping in
+        time, and ping the others, by batches."""
+        loop = self.app.loop
+        now = loop.time()
+        # Same payload for all: the frame is only encoded once.
+        data = struct.pack("!I", random.getrandbits(32))
+        frame = []
+        Frame(True, OP_PING, data).write(frame.append, mask=False)
+        frame = b"".join(frame)
+        for index, ws in enumerate(list(self.connections)):
+            if index and not index % self.batch:
+                # Let the loop breathe.
+                await asyncio.sleep(0)
+            if ws.state is not State.OPEN:
+                continue
+            pending = self.pending.get(ws)
+            if pending is not None and not pending[0].done():
+                if now - pending[1] >= self.timeout:
+                    del self.pending[ws]
+                    self.closed += 1
+                    ws.fail_connection(1011)
+                continue
+            waiter = ws.pings[data] = loop.create_future()
+            ws.transport.write(frame)
+            self.pending[ws] = waiter, now
+            self.pings += 1
+
+    def add(self, ws):
+        self.connections.add(ws)
+        if self.task is None:
+            self.task = self.app.loop.create_task(self.run())
+
+    def discard(self, ws):
+        self.connections.discard(ws)
+        self.pending.pop(ws, None)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def websockets_keepalive(app, interval=20, timeout=20, jitter=0.1, batch=1000):
+    keepalive = KeepAlive(app, interval, timeout, jitter, batch)
+
+    class WebsocketProtocol(app.WebsocketProtocol):
+        PING_INTERVAL = None  # Handled by the shared keepalive.
+
+    app.WebsocketProtocol = WebsocketProtocol
+
+    @app.listen("websocket_connect")
+    async def add(request, ws):
+        keepalive.add(ws)
+
+    @app.listen("websocket_disconnect")
+    async def remove(request, ws):
+        keepalive.discard(ws)
+
+    @app.listen("shutdown")
+    async def stop():
+        keepalive.stop()
+
+    return keepalive
+
+
+def websockets_store(app, max_buffer=2**20, policy="close"):
     if "websockets" not in app:
         app["websockets"] = set()
     assert isinstance(app["websockets"], set)
+    if not isinstance(app["websockets"], WebsocketsStore):
+        app["websockets"] = WebsocketsStore(app["websockets"], max_buffer, policy)
+    store = app["websockets"]
 
     @app.listen("websocket_connect")
-    async def store(request, ws):
-        request.app["websockets"].add(ws)
+    async def add(request, ws):
+        store.add(ws)
 
     @app.listen("websocket_disconnect")
     async def remove(request, ws):
-        request.app["websockets"].discard(ws)
+        store.discard(ws)
+
+    return store
+
+
+def channels(app, path=None):
+    layer = Channels(path)
+
+    @app.listen("startup")
+    async def connect():
+        await layer.connect()
+
+    @app.listen("shutdown")
+    async def close():
+        layer.close()
+
+    return layer
+
+
+class AccessLog:
+    """Access log written by a background thread.
+
+    Requests are recorded as tuples in a bounded queue, which are formatted
+    and written by batches in a thread. When the queue is full, lines are
+    dropped and counted, instead of blocking the event loop.
+    """
+
+    COMMON = '%s - - [%s] "%s %s HTTP/%s" %d %d\n'
+    COMBINED = '%s - - [%s] "%s %s HTTP/%s" %d %d "%s" "%s"\n'
+    BATCH_SIZE = 1000
+
+    def __init__(self, stream, format, max_queue, flush_interval):
+        if format not in ("common", "combined", "json"):
+            raise ValueError(f"Unknown access log format: {format}")
+        self.stream = stream
+        self.opened = False  # Whether the stream must be closed.
+        self.format = format
+        self.queue = queue.Queue(max_queue)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+
+    def record(self, entry: tuple):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if isinstance(self.stream, (str, Path)):
+            self.stream = open(self.stream, "a", buffering=65536)
+            self.opened = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the pending lines and wait for the thread to end. Blocking:
+        run it in an executor from the event loop."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.opened:
+                self.stream.close()
+                self.opened = False
+
+    def run(self):
+        running = True
+        while running:
+            try:
+                entry = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            entries = []
+            while entry is not None:
+                entries.append(entry)
+                if len(entries) == self.BATCH_SIZE:
+                    break
+                try:
+                    entry = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                # Stopped, the lines recorded since then are dropped.
+                running = False
+            if entries:
+                self.stream.write("".join(self.format_entries(entries)))
+                self.stream.flush()
+                self.written += len(entries)
+
+    def format_entries(self, entries):
+        last, date = None, None
+        for entry in entries:
+            when, remote, method, url, version, status, size, duration, ref, ua = entry
+            if self.format == "json":
+                yield json.dumps(
+                    {
+                        "time": when,
+                        "remote": remote,
+                        "method": method,
+                        "url": url,
+                        "status": status,
+                        "bytes": size,
+                        "duration": duration,
+                        "referrer": ref,
+                        "user_agent": ua,
+                    }
+                ) + "\n"
+                continue
+            second = int(when)
+            if second != last:
+                last = second
+                date = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(second))
+            if self.format == "common":
+                yield self.COMMON % (remote, date, method, url, version, status, size)
+            else:
+                yield self.COMBINED % (
+                    remote,
+                    date,
+                    method,
+                    url,
+                    version,
+                    status,
+                    size,
+                    ref or "-",
+                    ua or "-",
+                )
+
+
+def access_log(app, stream=None, format="combined", max_queue=10000, flush_interval=1):
+    log = AccessLog(stream or sys.stdout, format, max_queue, flush_interval)
+    perf_counter = time.perf_counter
+
+    @app.listen("headers")
+    async def start_timer(request, response):
+        request["_access_log"] = perf_counter()
+
+    @app.listen("response")
+    async def record_request(request, response):
+        start = request.get("_access_log")
+        duration = perf_counter() - start if start is not None else 0
+        protocol = request.protocol
+        peer = protocol.transport.get_extra_info("peername")
+        body = response.body
+        headers = request.headers
+        log.record(
+            (
+                time.time(),
+                peer[0] if isinstance(peer, tuple) else "-",
+                request.method,
+                request.url.decode(errors="replace"),
+                protocol.parser.get_http_version(),
+                response.status.value,
+                len(body) if isinstance(body, (bytes, str)) else 0,
+                duration,
+                headers.get("REFERER"),
+                headers.get("USER-AGENT"),
+            )
+        )
+
+    @app.listen("startup")
+    async def start_thread():
+        log.start()
+
+    @app.listen("shutdown")
+    async def stop_thread():
+        await app.loop.run_in_executor(None, log.stop)
+
+    return log
 
 
 def logger(app, level=logging.DEBUG, handler=None):
@@ -106,24 +515,675 @@ def igniter(app):
         """)
 
 
-def simple_server(app, port=3579, host="127.0.0.1", quiet=False):
+def simple_server(app, port=3579, host="127.0.0.1", quiet=False, grace=30):
     app.loop = asyncio.get_event_loop()
     app.loop.run_until_complete(app.startup())
     if not quiet:
         print(f"Rolling on http://{host}:{port}")
-    server = app.loop.create_server(app.factory, host, port)
-    app.loop.create_task(server)
+    server = app.loop.run_until_complete(
+        app.loop.create_server(app.factory, host, port)
+    )
     try:
         app.loop.run_forever()
     except KeyboardInterrupt:
         if not quiet:
             print("Bye.")
     finally:
-        app.loop.run_until_complete(app.shutdown())
         server.close()
+        drained, killed = app.loop.run_until_complete(app.drain(grace))
+        if not quiet and (drained or killed):
+            print(f"Drained {drained} request(s), killed {killed}.")
+        app.loop.run_until_complete(app.shutdown())
         app.loop.close()
 
 
+class TokenBuckets:
+    """Token buckets for many keys, stored in flat arrays.
+
+    Keys only map to a slot index, tokens and last refill timestamps live in
+    `array`s, so that each client costs two doubles instead of an object.
+    Buckets are refilled lazily, when consumed, and idle keys are evicted by
+    batches of slots, not to block the loop with many keys.
+    """
+
+    __slots__ = ("rate", "burst", "slots", "keys", "tokens", "stamps", "free", "cursor")
+
+    def __init__(self, rate: float, burst: float = None):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        if burst is None:
+            burst = max(rate, 1)
+        elif burst < 1:
+            raise ValueError(f"Burst must be at least 1, got {burst}")
+        self.rate = rate
+        self.burst = burst
+        self.slots = {}
+        self.keys = []  # Slot => key, None when free.
+        self.tokens = array("d")
+        self.stamps = array("d")
+        self.free = []
+        self.cursor = 0  # Next slot to check for eviction.
+
+    def __len__(self):
+        return len(self.slots)
+
+    def consume(self, key, now: float):
+        """Take a token for `key`, return the seconds to wait if none left."""
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.keys[slot] = key
+            else:
+                slot = len(self.tokens)
+                self.keys.append(key)
+                self.tokens.append(0)
+                self.stamps.append(0)
+            self.slots[key] = slot
+            tokens = self.burst
+        else:
+            tokens = self.tokens[slot] + (now - self.stamps[slot]) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+        self.stamps[slot] = now
+        if tokens < 1:
+            self.tokens[slot] = tokens
+            return (1 - tokens) / self.rate
+        self.tokens[slot] = tokens - 1
+        return 0
+
+    def evict(self, now: float, count: int = None):
+        """Forget keys whose bucket is full again: they have been idle.
+
+        Only check `count` slots (all if `None`), from where the previous call
+        stopped. Return True once all the slots have been checked.
+        """
+        keys, tokens, stamps = self.keys, self.tokens, self.stamps
+        start = self.cursor
+        end = len(keys) if count is None else min(len(keys), start + count)
+        for slot in range(start, end):
+            key = keys[slot]
+            if (
+                key is not None
+                and tokens[slot] + (now - stamps[slot]) * self.rate >= self.burst
+            ):
+                del self.slots[key]
+                keys[slot] = None
+                self.free.append(slot)
+        self.cursor = 0 if end >= len(keys) else end
+        return not self.cursor
+
+
+def ratelimit(app, rate=10, burst=None, key=None, evict_every=60, evict_batch=1000):
+    if key is None:
+
+        def key(request):
+            peername = request.protocol.transport.get_extra_info("peername")
+            return peername[0] if peername else None
+
+    elif isinstance(key, str):
+        header = key.upper()
+
+        def key(request):
+            return request.headers.get(header)
+
+    buckets = TokenBuckets(rate, burst)
+    # Per route buckets, by route payload.
+    routes = {}
+    # Bucket sets left to sweep, and the next sweep (or batch) call.
+    sweeping = []
+    sweeper = None
+
+    def route_buckets(limit):
+        if not isinstance(limit, (tuple, list)):
+            limit = (limit,)
+        return TokenBuckets(*limit)
+
+    @app.listen("route:add")
+    def check_route_limit(path, view, **extras):
+        limit = extras.get("ratelimit")
+        if limit:
+            route_buckets(limit)  # Fail early on invalid values.
+
+    def evict():
+        nonlocal sweeper
+        if not sweeping:
+            sweeping.extend((buckets, *routes.values()))
+        if sweeping[-1].evict(time.monotonic(), evict_batch):
+            sweeping.pop()
+        if sweeping:
+            # Let the requests be handled between two batches.
+            sweeper = app.loop.call_soon(evict)
+        else:
+            sweeper = app.loop.call_later(evict_every, evict)
+
+    @app.listen("startup")
+    async def start_eviction():
+        nonlocal sweeper
+        sweeper = app.loop.call_later(evict_every, evict)
+
+    @app.listen("shutdown")
+    async def stop_eviction():
+        if sweeper is not None:
+            sweeper.cancel()
+
+    @app.listen("headers")
+    async def check_ratelimit(request, response):
+        client = key(request)
+        if client is None:
+            return
+        now = time.monotonic()
+        current = buckets
+        payload = request.route.payload
+        if payload and "ratelimit" in payload:
+            limit = payload["ratelimit"]
+            if not limit:
+                return
+            current = routes.get(id(payload))
+            if current is None:
+                current = routes[id(payload)] = route_buckets(limit)
+        wait = current.consume(client, now)
+        if wait:
+            response.headers["Retry-After"] = str(math.ceil(wait))
+            raise HttpError(HTTPStatus.TOO_MANY_REQUESTS)
+
+    return buckets
+
+
+class LoadShedder:
+    """Admission control from in flight requests count and event loop lag.
+
+    With `adaptive`, the in flight limit follows an AIMD scheme: it grows by
+    `1/limit` for each request served under `target` seconds, and is
+    multiplied by `backoff` for a slower one. It's decreased only once per
+    window: the slow requests started before the last decrease are ignored.
+    """
+
+    def __init__(
+        self,
+        max_inflight=None,
+        max_lag=None,
+        adaptive=False,
+        target=0.1,
+        backoff=0.9,
+        min_limit=1,
+        max_limit=1000,
+    ):
+        if max_inflight is None:
+            # The adaptive limit starts from its upper bound.
+            max_inflight = max_limit if adaptive else math.inf
+        self.limit = max_inflight
+        self.max_lag = max_lag
+        self.adaptive = adaptive
+        self.target = target
+        self.backoff = backoff
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.lag = 0.0
+        self.shed = 0
+        self.decreased = -math.inf
+
+    def admit(self):
+        if self.inflight >= self.limit or (
+            self.max_lag is not None and self.lag > self.max_lag
+        ):
+            self.shed += 1
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self, started: float, now: float):
+        self.inflight -= 1
+        if not self.adaptive:
+            return
+        if now - started > self.target:
+            if started >= self.decreased:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.decreased = now
+        elif self.inflight * 2 >= self.limit:
+            # Only grow when the current limit is actually in use.
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+def load_shedding(
+    app, max_inflight=None, max_lag=None, retry_after=1, lag_interval=0.1, **kwargs
+):
+    shedder = LoadShedder(max_inflight, max_lag, **kwargs)
+    # Computed once for all, we don't want to do any work when overloaded.
+    rejection = (
+        b"HTTP/1.1 503 Service Unavailable\r\n"
+        b"Retry-After: %d\r\n"
+        b"Content-Length: 0\r\n"
+        b"Connection: close\r\n\r\n" % retry_after
+    )
+    probe = None
+
+    class SheddingProtocol(app.HttpProtocol):
+        __slots__ = ("started",)
+
+        def __init__(self, app):
+            super().__init__(app)
+            self.started = None
+
+        def on_headers_complete(self):
+            if self.parser.should_upgrade():
+                # Long lived connections are not requests in flight.
+                return super().on_headers_complete()
+            if not shedder.admit():
+                self.transport.write(rejection)
+                self.transport.close()
+                return
+            self.started = self.app.loop.time()
+            try:
+                super().on_headers_complete()
+            except Exception:
+                shedder.inflight -= 1
+                raise
+            self.task.add_done_callback(self.release)
+
+        async def write_body(self):
+            if self.is_chunked:
+                # Streamed (eg. SSE): not in flight anymore once the headers
+                # are sent, long lived responses would hold the slots.
+                self.release()
+            await super().write_body()
+
+        def release(self, task=None):
+            if self.started is not None:
+                shedder.release(self.started, self.app.loop.time())
+                self.started = None
+
+    app.HttpProtocol = SheddingProtocol
+
+    def measure_lag(expected):
+        nonlocal probe
+        now = app.loop.time()
+        shedder.lag = now - expected
+        probe = app.loop.call_at(now + lag_interval, measure_lag, now + lag_interval)
+
+    @app.listen("startup")
+    async def start_lag_probe():
+        measure_lag(app.loop.time())
+
+    @app.listen("shutdown")
+    async def stop_lag_probe():
+        if probe is not None:
+            probe.cancel()
+
+    return shedder
+
+
+class LagMonitor:
+    """Event loop lag measures, and blocking calls watchdog.
+
+    The request of each task is recorded, for the watchdog thread to know
+    which one is blocking from the current task of the loop. The tasks created
+    while handling a request (eg. with `asyncio.gather`) are recorded too,
+    through a task factory (Python 3.7+, as it needs `contextvars`).
+    """
+
+    def __init__(self, app, interval, threshold, logger):
+        self.app = app
+        self.interval = interval
+        self.threshold = threshold
+        self.logger = logger
+        self.histogram = Histogram(LATENCY_BOUNDS)
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self.probe = None
+        self.thread = None
+        self.loop_thread = None
+        self.stopped = threading.Event()
+        self.request = None
+        if contextvars is not None:
+            self.request = contextvars.ContextVar("request", default=None)
+        self.requests = weakref.WeakKeyDictionary()  # Task => request.
+        self.task_factory = None
+
+    def enter(self, request):
+        if self.request is not None:
+            self.request.set(request)
+        self.requests[current_task(self.app.loop)] = request
+
+    def create_task(self, loop, coroutine, **kwargs):
+        # Eg. `context`, given by the loop on Python 3.11+.
+        if self.task_factory is None:
+            task = asyncio.Task(coroutine, loop=loop, **kwargs)
+        else:
+            task = self.task_factory(loop, coroutine, **kwargs)
+        request = self.request.get()
+        if request is not None:
+            self.requests[task] = request
+        return task
+
+    def measure(self, expected):
+        now = time.monotonic()
+        self.histogram.observe(now - expected)
+        self.heartbeat = now
+        self.probe = self.app.loop.call_later(
+            self.interval, self.measure, now + self.interval
+        )
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        if self.request is not None:
+            self.task_factory = self.app.loop.get_task_factory()
+            self.app.loop.set_task_factory(self.create_task)
+        self.measure(time.monotonic())
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.probe is not None:
+            self.probe.cancel()
+        if self.app.loop.get_task_factory() == self.create_task:
+            self.app.loop.set_task_factory(self.task_factory)
+
+    def watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked > self.threshold and heartbeat != reported:
+                reported = heartbeat
+                self.stalls += 1
+                self.report(blocked)
+
+    def report(self, blocked):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+        route = "-"
+        request = self.requests.get(current_task(self.app.loop))
+        if request is not None:
+            route = f"{request.method} {request.route.payload['_path']}"
+        self.logger.warning(
+            "Event loop blocked for more than %.3fs, while handling %s\n%s",
+            blocked,
+            route,
+            "".join(format_stack(frame)),
+        )
+
+
+def lag_monitor(app, interval=0.01, threshold=0.1, logger=None):
+    monitor = LagMonitor(app, interval, threshold, logger or logging.getLogger("roll"))
+
+    @app.listen("request")
+    async def record_request(request, response):
+        monitor.enter(request)
+
+    @app.listen("startup")
+    async def start_monitor():
+        monitor.start()
+
+    @app.listen("shutdown")
+    async def stop_monitor():
+        monitor.stop()
+
+    return monitor
+
+
+def metrics(
+    app, path="/metrics", bounds=LATENCY_BOUNDS, max_routes=256, workers=None
+):
+    if workers:
+        registry = SharedMetrics(bounds, max_routes, workers)
+    else:
+        registry = Metrics(bounds, max_routes)
+    perf_counter = time.perf_counter
+
+    @app.listen("route:add")
+    def add_route(path, view, **extras):
+        # Preallocate the route row.
+        registry.route(path)
+
+    @app.listen("headers")
+    async def start_request(request, response):
+        payload = request.route.payload
+        offset = registry.route(payload["_path"] if payload else "")
+        registry.start(offset)
+        request["_metrics"] = offset, perf_counter()
+
+    @app.listen("response")
+    async def record_request(request, response):
+        started = request.get("_metrics")
+        if started is None:
+            return
+        offset, start = started
+        body = response.body
+        registry.record(
+            offset,
+            response.status,
+            perf_counter() - start,
+            len(request._body) if request._body else 0,
+            len(body) if isinstance(body, (bytes, str)) else 0,
+        )
+
+    async def serve_metrics(request, response):
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        response.body = registry.render()
+
+    app.route(path, name="metrics")(serve_metrics)
+    return registry
+
+
+def timings(app, server_timing=False):
+    perf_counter = time.perf_counter
+    HOOKS = ("headers", "request", "response", "error")
+
+    class TimedRequest(app.Request):
+        __slots__ = ("timings", "started", "called")
+
+        def __init__(self, app, protocol):
+            self.started = perf_counter()
+            self.called = None
+            self.timings = {}
+            super().__init__(app, protocol)
+
+    class TimedProtocol(app.HttpProtocol):
+        __slots__ = ()
+
+        def on_url(self, url: bytes):
+            start = perf_counter()
+            super().on_url(url)
+            self.request.timings["lookup"] = perf_counter() - start
+
+        def on_headers_complete(self):
+            request = self.request
+            request.timings["parse"] = perf_counter() - request.started
+            super().on_headers_complete()
+
+        async def __call__(self):
+            request = self.request
+            request.called = perf_counter()
+            await super().__call__()
+            request.timings["total"] = perf_counter() - request.started
+            await app.hook("timing", request, self.response)
+
+        async def write(self, *args):
+            request = getattr(self, "request", None)
+            if request is None or request.called is None or "view" in request.timings:
+                # Not a response to a handled request (eg. a parsing error).
+                return await super().write(*args)
+            timings = request.timings
+            start = perf_counter()
+            # Whatever is not spent in hooks is spent loading the body and in
+            # the view.
+            timings["view"] = (
+                start - request.called - sum(timings.get(n, 0) for n in HOOKS)
+            )
+            if server_timing:
+                self.response.headers["Server-Timing"] = ", ".join(
+                    f"{name};dur={duration * 1000:.3f}"
+                    for name, duration in timings.items()
+                )
+            await super().write(*args)
+            timings["write"] = perf_counter() - start
+
+    class TimedHooks(list):
+        """Functions of a hook, each timed when called."""
+
+        def __init__(self, name, functions=()):
+            self.name = name
+            super().__init__(self.timed(function) for function in functions)
+
+        def append(self, function):
+            super().append(self.timed(function))
+
+        def timed(self, function):
+            name = self.name
+
+            async def timed(request, *args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await function(request, *args, **kwargs)
+                finally:
+                    timings = getattr(request, "timings", None)
+                    if timings is not None:
+                        duration = perf_counter() - start
+                        timings[name] = timings.get(name, 0) + duration
+
+            return timed
+
+    app.Request = TimedRequest
+    app.HttpProtocol = TimedProtocol
+    for name in HOOKS:
+        app.hooks[name] = TimedHooks(name, app.hooks[name])
+
+
+class Profiled:
+    """Await `coroutine` with `profile` enabled only while it runs, and not
+    while it's suspended, so the other tasks running meanwhile are not
+    profiled along."""
+
+    __slots__ = ("coroutine", "profile")
+
+    def __init__(self, coroutine, profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        coroutine, profile = self.coroutine, self.profile
+        value, error = None, None
+        while True:
+            profile.enable()
+            try:
+                if error is None:
+                    future = coroutine.send(value)
+                else:
+                    future = coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                profile.disable()
+            value, error = None, None
+            try:
+                value = yield future
+            except GeneratorExit:
+                coroutine.close()
+                raise
+            except BaseException as exc:  # Eg. the task is cancelled.
+                error = exc
+
+
+class Profiler:
+    """Profile sampled requests with cProfile, aggregating stats per route."""
+
+    def __init__(self, rate, secret, directory):
+        self.rate = rate
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.directory = Path(directory) if directory else None
+        self.stats = {}  # Route path => pstats.Stats
+
+    def sign(self, path: str):
+        """Return the trigger header value to profile a request to `path`."""
+        return hmac.new(self.secret, path.encode(), hashlib.sha256).hexdigest()
+
+    def verify(self, path: str, signature: str):
+        return bool(self.secret and signature) and hmac.compare_digest(
+            self.sign(path), signature
+        )
+
+    async def run(self, route: str, coroutine):
+        """Profile `coroutine`, and add its stats to `route` ones."""
+        profile = cProfile.Profile()
+        try:
+            return await Profiled(coroutine, profile)
+        finally:
+            self.record(route, profile)
+
+    def record(self, route: str, profile):
+        if route in self.stats:
+            self.stats[route].add(profile)
+        else:
+            self.stats[route] = pstats.Stats(profile)
+        if self.directory:
+            name = route.strip("/").replace("/", "_") or "root"
+            self.stats[route].dump_stats(self.directory / f"{name}.prof")
+
+    def dump(self, route: str):
+        """Return the stats of `route` in the pstats (marshal) format."""
+        return marshal.dumps(self.stats[route].stats)
+
+    def text(self, route: str, sort="cumulative", limit=50):
+        out = io.StringIO()
+        stats = self.stats[route]
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+def profiler(app, rate=0.01, header=None, secret=None, path=None, directory=None):
+    profiler = Profiler(rate, secret, directory)
+    if header:
+        header = header.upper()
+
+    class ProfiledProtocol(app.HttpProtocol):
+        __slots__ = ()
+
+        def __call__(self):
+            coroutine = super().__call__()
+            request = self.request
+            payload = request.route.payload
+            if payload and (
+                random.random() < profiler.rate
+                or (
+                    header
+                    and profiler.verify(request.path, request.headers.get(header))
+                )
+            ):
+                return profiler.run(payload["_path"], coroutine)
+            return coroutine
+
+    app.HttpProtocol = ProfiledProtocol
+
+    if path:
+
+        @app.route(path, name="profiler")
+        async def serve_profile(request, response):
+            if not header or not profiler.verify(path, request.headers.get(header)):
+                raise HttpError(HTTPStatus.FORBIDDEN)
+            route = request.query.get("route", None)
+            if route is None:
+                response.body = "".join(
+                    f"{route} {stats.total_calls} {stats.total_tt:.6f}\n"
+                    for route, stats in profiler.stats.items()
+                )
+            elif route not in profiler.stats:
+                raise HttpError(HTTPStatus.NOT_FOUND, f"No profile for {route}")
+            elif request.query.get("format", "text") == "pstats":
+                response.headers["Content-Type"] = "application/octet-stream"
+                response.body = profiler.dump(route)
+            else:
+                response.body = profiler.text(
+                    route, request.query.get("sort", "cumulative")
+                )
+
+    return profiler
+
+
 def static(app, prefix="/static/", root=Path(), default_index="", name="static"):
     """Serve static files. Never use in production."""
 
@@ -1,5 +1,7 @@
 import asyncio
+from heapq import heappop, heappush
 from http import HTTPStatus
+from itertools import count
 from io import BytesIO
 from typing import TypeVar
 from urllib.parse import unquote
@@ -18,6 +20,11 @@ STATUSES = {}
 for status in HTTPStatus:
     STATUSES[status.value] = status
 
+if hasattr(asyncio, "current_task"):  # Python 3.7+
+    current_task = asyncio.current_task
+else:
+    current_task = asyncio.Task.current_task
+
 
 class HttpError(Exception):
     """Exception meant to be raised when an error is occurring.
@@ -43,6 +50,82 @@ class HttpError(Exception):
         self.message = message or self.status.phrase
 
 
+class ConcurrencyLimit:
+    """Limit the number of concurrent calls, queueing the others.
+
+    Queued calls are admitted by `priority` (lowest first), then by arrival
+    order. One instance can be shared by many routes, eg. to protect a fragile
+    backend they all rely on.
+    """
+
+    def __init__(self, max_concurrency: int, queue_size: int = None):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = 0
+        self._waiters = []
+        self._counter = count()
+        # For monitoring.
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def acquire(self, priority: int = 0, timeout: float = None):
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+        if self.queue_size is not None and self.waiting >= self.queue_size:
+            self.rejected += 1
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many queued requests")
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        heappush(self._waiters, (priority, next(self._counter), future))
+        self.waiting += 1
+        start = loop.time()
+        # Not `asyncio.wait_for`, which can lose a cancellation (eg. the
+        # request deadline) when the slot is given at the same time.
+        timer = None
+        if timeout is not None:
+            timer = loop.call_later(timeout, self._expire, future)
+        try:
+            await future
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "Timed out in queue")
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.waiting -= 1
+            self.waited += 1
+            wait_time = loop.time() - start
+            self.wait_time += wait_time
+            if wait_time > self.max_wait_time:
+                self.max_wait_time = wait_time
+
+    def release(self):
+        while self._waiters:
+            future = heappop(self._waiters)[2]
+            if not future.done():
+                # Hand the slot over, active count is unchanged.
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _expire(self, future):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    def _abandon(self, future):
+        if future.done() and not future.cancelled() and not future.exception():
+            # We have been given a slot in the meantime, pass it on.
+            self.release()
+
+
 class Multidict(dict):
     """Data structure to deal with several values for the same key.
 
@@ -71,6 +154,43 @@ class Query(Multidict):
     TRUE_STRINGS = ("t", "true", "yes", "1", "on")
     FALSE_STRINGS = ("f", "false", "no", "0", "off")
     NONE_STRINGS = ("n", "none", "null")
+    # Limits against abusive query strings (eg. hash flooding), None to disable.
+    MAX_KEYS = 1000
+    MAX_LENGTH = None
+
+    @classmethod
+    def parse(cls, query_string: str):
+        """Parse `query_string` like `parse_qs(…, keep_blank_values=True)`,
+        in one pass, only unquoting the parts that need it."""
+        query = cls()
+        if not query_string:
+            return query
+        if cls.MAX_LENGTH is not None and len(query_string) > cls.MAX_LENGTH:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Query string too long")
+        plain = "%" not in query_string and "+" not in query_string
+        max_keys = cls.MAX_KEYS
+        for pair in query_string.split("&"):
+            if not pair:
+                continue
+            key, _, value = pair.partition("=")
+            if not plain:
+                if "+" in key:
+                    key = key.replace("+", " ")
+                if "%" in key:
+                    key = unquote(key)
+                if "+" in value:
+                    value = value.replace("+", " ")
+                if "%" in value:
+                    value = unquote(value)
+            # Multidict.get returns the first value.
+            values = dict.get(query, key)
+            if values is None:
+                if max_keys is not None and len(query) >= max_keys:
+                    raise HttpError(HTTPStatus.BAD_REQUEST, "Too many query keys")
+                query[key] = [value]
+            else:
+                values.append(value)
+        return query
 
     def bool(self, key: str, default=...):
         value = self.get(key, default)
@@ -185,6 +305,36 @@ class Cookies(dict):
         self[name] = Cookie(name, *args, **kwargs)
 
 
+# Set-Cookie values by cookie attributes: most responses set the same cookies.
+SET_COOKIE_CACHE = {}
+SET_COOKIE_CACHE_SIZE = 1024
+
+
+def set_cookie_header(cookie: Cookie):
+    """Return the serialized `cookie`, as bytes."""
+    if type(cookie) is not Cookie:
+        # May have other attributes.
+        return str(cookie).encode()
+    key = (
+        cookie.name,
+        cookie.value,
+        cookie.path,
+        cookie.domain,
+        cookie.secure,
+        cookie.httponly,
+        cookie.max_age,
+        cookie.expires,
+        cookie.samesite,
+    )
+    header = SET_COOKIE_CACHE.get(key)
+    if header is None:
+        header = str(cookie).encode()
+        if len(SET_COOKIE_CACHE) >= SET_COOKIE_CACHE_SIZE:
+            SET_COOKIE_CACHE.clear()
+        SET_COOKIE_CACHE[key] = header
+    return header
+
+
 class HTTPProtocol(asyncio.Protocol):
     """Responsible of parsing the request and writing the response."""
 
@@ -197,6 +347,8 @@ class HTTPProtocol(asyncio.Protocol):
         "task",
         "is_chunked",
         "draining",
+        "receiving",
+        "websocket",
     )
     _BODYLESS_METHODS = ("HEAD", "CONNECT")
     _BODYLESS_STATUSES = (
@@ -216,9 +368,16 @@ class HTTPProtocol(asyncio.Protocol):
         self.task = None
         self.is_chunked = False
         self.draining = False
+        # A request has begun, but its handling task is not created yet.
+        self.receiving = False
+        self.websocket = None  # Protocol the connection has been upgraded to.
 
     def connection_made(self, transport):
         self.transport = transport
+        self.app.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.app.connections.discard(self)
 
     def data_received(self, data: bytes):
         try:
@@ -228,6 +387,7 @@ class HTTPProtocol(asyncio.Protocol):
             # We acted upon the upgrade earlier, so we just pass.
             pass
         except HttpParserError as error:
+            self.receiving = False
             # If the parsing failed before on_message_begin, we don't have a
             # response.
             self.response = self.app.Response(self.app, self)
@@ -250,14 +410,18 @@ class HTTPProtocol(asyncio.Protocol):
             raise HttpError(HTTPStatus.NOT_IMPLEMENTED, "Request cannot be upgraded.")
 
         protocol_class = self.request.route.payload["_protocol_class"]
-        new_protocol = protocol_class(self.request)
+        new_protocol = self.websocket = protocol_class(self.request)
         new_protocol.handshake(self.response)
         self.response.status = HTTPStatus.SWITCHING_PROTOCOLS
         await self.write()
         new_protocol.connection_made(self.transport)
         new_protocol.connection_open()
         self.transport.set_protocol(new_protocol)
-        await new_protocol.run()
+        try:
+            await new_protocol.run()
+        finally:
+            # We'll not receive the connection_lost call anymore.
+            self.app.connections.discard(self)
 
     # All on_xxx methods are in use by httptools parser.
     # See https://github.com/MagicStack/httptools#apis
@@ -282,6 +446,7 @@ class HTTPProtocol(asyncio.Protocol):
         self.app.lookup(self.request)
 
     def on_message_begin(self):
+        self.receiving = True
         self.request = self.app.Request(self.app, self)
         self.response = self.app.Response(self.app, self)
 
@@ -289,6 +454,7 @@ class HTTPProtocol(asyncio.Protocol):
         self.request.queue.end()
 
     def on_headers_complete(self):
+        self.receiving = False
         if self.parser.should_upgrade():
             # An upgrade has been requested
             self.request.upgrade = self.request.headers["UPGRADE"].lower()
@@ -314,12 +480,23 @@ class HTTPProtocol(asyncio.Protocol):
 
     async def write_body(self):
         if self.is_chunked:
-            async for data in self.response.body:
-                # Writing the chunk.
-                if not isinstance(data, bytes):
-                    data = str(data).encode()
-                self.transport.write(b"%x\r\n%b\r\n" % (len(data), data))
-            self.transport.write(b"0\r\n\r\n")
+            body = self.response.body
+            try:
+                async for data in body:
+                    if self.transport.is_closing():
+                        # The client is gone, stop producing the body.
+                        return
+                    # Writing the chunk.
+                    if not isinstance(data, bytes):
+                        data = str(data).encode()
+                    self.transport.write(b"%x\r\n%b\r\n" % (len(data), data))
+                # Not written when cancelled (eg. by `Roll.drain`), so the
+                # client knows the body is incomplete.
+                self.transport.write(b"0\r\n\r\n")
+            finally:
+                # Release the resources of an unfinished generator now.
+                if hasattr(body, "aclose"):
+                    await body.aclose()
         else:
             self.transport.write(self.response.body)
 
@@ -347,10 +524,12 @@ class HTTPProtocol(asyncio.Protocol):
                     length = len(self.response.body)
                     self.response.headers["Content-Length"] = length
 
+        if self.app.closing:
+            self.response.headers["Connection"] = "close"
         if self.response._cookies:
             # https://tools.ietf.org/html/rfc7230#page-23
             for cookie in self.response.cookies.values():
-                payload += b"Set-Cookie: %b\r\n" % str(cookie).encode()
+                payload += b"Set-Cookie: %b\r\n" % set_cookie_header(cookie)
         for key, value in self.response.headers.items():
             payload += b"%b: %b\r\n" % (key.encode(), str(value).encode())
         payload += b"\r\n"
@@ -366,7 +545,7 @@ class HTTPProtocol(asyncio.Protocol):
             # TODO: Pass into error hook when write is async.
             pass
         else:
-            if not self.parser.should_keep_alive():
+            if self.app.closing or not self.parser.should_keep_alive():
                 self.transport.close()
         # Drain request body, in case an error has raised before fully
         # consuming it in the normal process, so the transport is free to handle
@@ -1,4 +1,5 @@
 from asyncio import Event
+from functools import lru_cache
 from http import HTTPStatus
 from queue import deque
 from urllib.parse import parse_qs
@@ -18,6 +19,10 @@ except ImportError:
     from json.decoder import JSONDecodeError
 
 
+# Clients send the same Cookie header again and again.
+parse_cookies = lru_cache(maxsize=1024)(parse)
+
+
 class StreamQueue:
     def __init__(self):
         self.items = deque()
@@ -83,6 +88,7 @@ class Request(dict):
         "protocol",
         "queue",
         "_json",
+        "deadline",
     )
 
     def __init__(self, app, protocol):
@@ -99,18 +105,19 @@ class Request(dict):
         self._form = None
         self._files = None
         self._json = None
+        self.deadline = None
 
     @property
     def cookies(self):
         if self._cookies is None:
-            self._cookies = parse(self.headers.get("COOKIE", ""))
+            # Copy: the parsed mapping is shared by the cache.
+            self._cookies = dict(parse_cookies(self.headers.get("COOKIE", "")))
         return self._cookies
 
     @property
     def query(self):
         if self._query is None:
-            parsed_qs = parse_qs(self.query_string, keep_blank_values=True)
-            self._query = self.app.Query(parsed_qs)
+            self._query = self.app.Query.parse(self.query_string)
         return self._query
 
     def _parse_multipart(self):
@@ -178,6 +185,11 @@ class Request(dict):
     def origin(self):
         return self.headers.get("ORIGIN", "")
 
+    @property
+    def remaining(self):
+        if self.deadline is not None:
+            return max(0, self.deadline - self.app.loop.time())
+
     @property
     def body(self):
         if self._body is None:
@@ -240,6 +252,20 @@ class Response:
 
     json = property(None, json)
 
+    def sse(self, source):
+        # Serve Server-Sent Events from an `EventSource`, or from an async
+        # iterable of encoded events.
+        self.headers["Content-Type"] = "text/event-stream"
+        self.headers["Cache-Control"] = "no-cache"
+        # Do not let nginx buffer the events.
+        self.headers["X-Accel-Buffering"] = "no"
+        if hasattr(source, "stream"):
+            last_event_id = self.protocol.request.headers.get("LAST-EVENT-ID")
+            source = source.stream(self.protocol.transport, last_event_id)
+        self.body = source
+
+    sse = property(None, sse)
+
     @property
     def cookies(self):
         if self._cookies is None:
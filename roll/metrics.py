@@ -0,0 +1,264 @@
+import logging
+import mmap
+import multiprocessing
+import os
+import weakref
+from array import array
+from bisect import bisect_left
+
+
+class Histogram:
+    """Count values in fixed buckets, stored in a preallocated array.
+
+    `bounds` are the (inclusive) upper bounds of the buckets, in ascending
+    order; an extra bucket counts the values above the last bound.
+    """
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = array("Q", bytes(8 * (len(self.bounds) + 1)))
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the `q` quantile (0 < q <= 1)."""
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return float("inf")
+
+
+# Seconds, from 1ms to 10s.
+LATENCY_BOUNDS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Metrics:
+    """Requests metrics per route, stored in one preallocated flat array.
+
+    Each route owns a fixed size row: counts by status class, latency
+    histogram buckets, latency sum, request and response bytes, and requests
+    in flight. Recording a request is only a few additions in this array, all
+    the formatting is done when rendering.
+    """
+
+    STATUSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+    def __init__(self, bounds=LATENCY_BOUNDS, max_routes=256):
+        self.bounds = tuple(bounds)
+        self.max_routes = max_routes
+        self.routes = {}  # Route path => row offset.
+        self.buckets = len(self.STATUSES)
+        self.sum = self.buckets + len(self.bounds) + 1
+        self.bytes_in = self.sum + 1
+        self.bytes_out = self.sum + 2
+        self.inflight = self.sum + 3
+        self.width = self.sum + 4
+        self.data = self.allocate(self.max_routes * self.width)
+        # First row is for requests not matching any route.
+        self.route("")
+
+    def allocate(self, size: int):
+        return array("d", bytes(8 * size))
+
+    def route(self, path: str):
+        """Return the row offset of the route `path`, adding it if needed."""
+        offset = self.routes.get(path)
+        if offset is None:
+            if len(self.routes) >= self.max_routes:
+                return 0
+            offset = self.routes[path] = len(self.routes) * self.width
+        return offset
+
+    def start(self, offset: int):
+        self.data[offset + self.inflight] += 1
+
+    def record(self, offset, status, latency, bytes_in, bytes_out):
+        data = self.data
+        data[offset + status // 100 - 1] += 1
+        data[offset + self.buckets + bisect_left(self.bounds, latency)] += 1
+        data[offset + self.sum] += latency
+        data[offset + self.bytes_in] += bytes_in
+        data[offset + self.bytes_out] += bytes_out
+        data[offset + self.inflight] -= 1
+
+    def rows(self):
+        for path, offset in self.routes.items():
+            yield path, self.data[offset : offset + self.width]
+
+    def render(self):
+        """Return the metrics in Prometheus text format."""
+        requests = [
+            "# HELP roll_requests_total Requests count.",
+            "# TYPE roll_requests_total counter",
+        ]
+        durations = [
+            "# HELP roll_request_duration_seconds Requests latency.",
+            "# TYPE roll_request_duration_seconds histogram",
+        ]
+        bytes_in = [
+            "# HELP roll_request_bytes_total Requests body size.",
+            "# TYPE roll_request_bytes_total counter",
+        ]
+        bytes_out = [
+            "# HELP roll_response_bytes_total Responses body size.",
+            "# TYPE roll_response_bytes_total counter",
+        ]
+        inflight = [
+            "# HELP roll_requests_in_flight Requests being processed.",
+            "# TYPE roll_requests_in_flight gauge",
+        ]
+        bounds = [str(bound) for bound in self.bounds] + ["+Inf"]
+        for path, row in self.rows():
+            total = sum(row[: self.buckets])
+            if not total and not row[self.inflight]:
+                continue
+            route = 'route="%s"' % path.replace("\\", "\\\\").replace('"', '\\"')
+            for status, count in zip(self.STATUSES, row):
+                if count:
+                    requests.append(
+                        'roll_requests_total{%s,status="%s"} %d'
+                        % (route, status, count)
+                    )
+            cumulated = 0
+            for bound, count in zip(bounds, row[self.buckets : self.sum]):
+                cumulated += count
+                durations.append(
+                    'roll_request_duration_seconds_bucket{%s,le="%s"} %d'
+                    % (route, bound, cumulated)
+                )
+            durations.append(
+                "roll_request_duration_seconds_sum{%s} %s" % (route, row[self.sum])
+            )
+            durations.append(
+                "roll_request_duration_seconds_count{%s} %d" % (route, total)
+            )
+            bytes_in.append(
+                "roll_request_bytes_total{%s} %d" % (route, row[self.bytes_in])
+            )
+            bytes_out.append(
+                "roll_response_bytes_total{%s} %d" % (route, row[self.bytes_out])
+            )
+            inflight.append(
+                "roll_requests_in_flight{%s} %d" % (route, row[self.inflight])
+            )
+        return "\n".join(requests + durations + bytes_in + bytes_out + inflight) + "\n"
+
+
+class SharedMetrics(Metrics):
+    """Metrics shared by forked workers, through an anonymous shared memory.
+
+    The memory is allocated when the registry is created, so it must be
+    created before forking (eg. with a preloaded app). Each worker then claims
+    its own slot on its first request, and is the only one writing to it, so
+    without any lock. Rendering sums the rows of all the slots.
+
+    Routes must be known before forking too, for their rows to be at the same
+    offset in every worker: other ones are recorded with unmatched requests.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS, max_routes=256, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.lock = multiprocessing.Lock()
+        self.creator = os.getpid()
+        self.claimed = False
+        super().__init__(bounds, max_routes)
+        if hasattr(os, "register_at_fork"):  # Python 3.7+
+            ref = weakref.ref(self)
+
+            def forked():
+                metrics = ref()
+                if metrics is not None:
+                    metrics.claimed = False
+
+            # A forked process claims its own slot on its first request.
+            os.register_at_fork(after_in_child=forked)
+
+    def allocate(self, size: int):
+        # Owner pid of each slot, then the slots.
+        workers = self.workers
+        self.memory = mmap.mmap(-1, 8 * (workers + workers * size))
+        view = memoryview(self.memory)
+        self.owners = view[: 8 * workers].cast("q")
+        self.slots = [
+            view[8 * (workers + i * size) : 8 * (workers + (i + 1) * size)].cast("d")
+            for i in range(workers)
+        ]
+        # Private until a slot is claimed.
+        return array("d", bytes(8 * size))
+
+    def claim(self):
+        """Take the first free slot, or the one of a dead worker."""
+        pid = os.getpid()
+        if pid == self.creator:
+            logging.getLogger("roll").warning(
+                "Metrics claimed by the process that created them (%s): they "
+                "are not shared with the other workers, if any. Load the app "
+                "before forking them (eg. gunicorn --preload).",
+                pid,
+            )
+        with self.lock:
+            for index, owner in enumerate(self.owners):
+                if owner and owner != pid:
+                    try:
+                        os.kill(owner, 0)
+                        continue
+                    except ProcessLookupError:
+                        pass  # Dead worker, keep its counters.
+                    except PermissionError:
+                        continue
+                self.owners[index] = pid
+                self.data = self.slots[index]
+                # Requests of the dead worker are not in flight anymore.
+                for offset in range(0, len(self.data), self.width):
+                    self.data[offset + self.inflight] = 0
+                break
+            else:
+                logging.getLogger("roll").warning(
+                    "No metrics slot left for worker %s, increase `workers`.", pid
+                )
+        self.claimed = True
+
+    def route(self, path: str):
+        if self.claimed and path not in self.routes:
+            # Would not be at the same offset in other workers.
+            return 0
+        return super().route(path)
+
+    def start(self, offset: int):
+        if not self.claimed:
+            self.claim()
+        super().start(offset)
+
+    def rows(self):
+        for path, offset in self.routes.items():
+            columns = zip(*(slot[offset : offset + self.width] for slot in self.slots))
+            yield path, [sum(column) for column in columns]
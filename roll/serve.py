@@ -0,0 +1,401 @@
+"""Pre-fork server, with the workers accepting from one shared socket.
+
+The master binds and listens on the socket, then forks the workers, which
+inherit it and each run their own event loop. The app is loaded once, before
+forking. As the socket is never closed while the master runs, the connections
+waiting to be accepted are not lost when a worker stops (eg. on reload).
+
+With `--reuseport`, each worker listens on its own `SO_REUSEPORT` socket
+instead, and the kernel balances the connections between them; but the
+connections waiting in the queue of a stopping worker are then reset.
+
+    python -m roll.serve mypackage.core:app --workers 4
+"""
+
+import argparse
+import asyncio
+import gc
+import importlib
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+from .channels import spawn_broker
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def load_app(path: str):
+    """Import an app from a `module:attribute` path (attribute defaults to `app`)."""
+    module, _, name = path.partition(":")
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module), name or "app")
+
+
+def preload(app):
+    """Get a loaded app ready to be shared by forked workers. Run it once,
+    right before forking.
+
+    The hooks without functions are created now (`app.hooks` is a defaultdict,
+    written to on the first call of each hook), then all objects are moved to
+    the GC permanent generation: collections in workers will not touch them
+    anymore, so the memory pages stay shared with the master.
+    """
+    for name in (
+        "startup",
+        "shutdown",
+        "headers",
+        "request",
+        "response",
+        "error",
+        "timing",
+        "websocket_connect",
+        "websocket_disconnect",
+    ):
+        app.hooks[name]
+    gc.collect()
+    if hasattr(gc, "freeze"):  # Python 3.7+
+        gc.freeze()
+
+
+def parse_gc_threshold(value: str):
+    return tuple(int(v) for v in value.split(","))
+
+
+def memory_usage():
+    """Return `rss`, `shared` and `private` memory of the current process, in
+    bytes (Linux only, `None` otherwise)."""
+    usage = {"rss": 0, "shared": 0, "private": 0}
+    keys = {
+        "Rss": "rss",
+        "Shared_Clean": "shared",
+        "Shared_Dirty": "shared",
+        "Private_Clean": "private",
+        "Private_Dirty": "private",
+    }
+    for path in ("/proc/self/smaps_rollup", "/proc/self/smaps"):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in keys:
+                        usage[keys[key]] += int(value.split()[0]) * 1024
+        except OSError:
+            continue
+        return usage
+
+
+def format_memory(usage):
+    if usage is None:
+        return "unavailable"
+    return " ".join(f"{k}={v / 2 ** 20:.1f}MB" for k, v in usage.items())
+
+
+def run_worker(
+    app, sock, backlog=1024, grace=30, cpu=None, gc_threshold=None, quiet=False
+):
+    """Run the app in the current process, accepting connections from the
+    listening socket `sock`, until SIGTERM or SIGINT."""
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+    if gc_threshold:
+        gc.set_threshold(*gc_threshold)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app.loop = loop
+    loop.run_until_complete(app.startup())
+    server = loop.run_until_complete(
+        loop.create_server(app.factory, sock=sock, backlog=backlog)
+    )
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+
+    def log_memory():
+        if not quiet:
+            print(f"[{os.getpid()}] Memory: {format_memory(memory_usage())}")
+
+    loop.add_signal_handler(signal.SIGUSR2, log_memory)
+    log_memory()
+    parent = os.getppid()
+
+    def check_parent():
+        if os.getppid() != parent:
+            # Orphaned: the master has died.
+            loop.stop()
+        else:
+            loop.call_later(1, check_parent)
+
+    check_parent()
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        drained, killed = loop.run_until_complete(app.drain(grace))
+        if not quiet and (drained or killed):
+            print(f"[{os.getpid()}] Drained {drained} request(s), killed {killed}.")
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+class Master:
+    """Fork the workers, restart them when they die, reload them on SIGHUP."""
+
+    def __init__(
+        self,
+        app,
+        host="127.0.0.1",
+        port=3579,
+        workers=None,
+        backlog=1024,
+        grace=30,
+        pin=False,
+        gc_threshold=None,
+        quiet=False,
+        broker=None,
+        reuseport=False,
+    ):
+        if reuseport and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not available on this platform")
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.backlog = backlog
+        self.grace = grace
+        self.pin = pin
+        self.gc_threshold = gc_threshold
+        self.quiet = quiet
+        self.broker = broker  # Unix socket path of the channels broker.
+        self.reuseport = reuseport  # One listening socket per worker.
+        self.broker_pid = None
+        self.children = {}  # pid => worker index.
+        self.signals = []
+        self.socket = None
+        self.wakeup = None
+
+    def log(self, message):
+        if not self.quiet:
+            print(f"[{os.getpid()}] {message}")
+
+    def make_socket(self):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+
+    def listen(self, sock):
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def bind(self):
+        self.socket = self.make_socket()
+        self.port = self.socket.getsockname()[1]
+        if not self.reuseport:
+            # Shared by all the workers (the old and new ones during a reload).
+            self.listen(self.socket)
+        # Else, only bound to keep the port, the workers listen on their own.
+
+    def spawn(self, index):
+        cpu = index % (os.cpu_count() or 1) if self.pin else None
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return pid
+        # Do not keep the master state in the worker.
+        signal.set_wakeup_fd(-1)
+        for fd in self.wakeup:
+            os.close(fd)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        status = 0
+        try:
+            sock = self.socket
+            if self.reuseport:
+                sock = self.listen(self.make_socket())
+                self.socket.close()
+            run_worker(
+                self.app,
+                sock,
+                self.backlog,
+                self.grace,
+                cpu,
+                self.gc_threshold,
+                self.quiet,
+            )
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def spawn_broker(self):
+        return spawn_broker(
+            self.broker, close_fds=[self.socket.fileno(), *self.wakeup]
+        )
+
+    def kill(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        """Collect dead workers, return their indexes."""
+        dead = []
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid == self.broker_pid:
+                self.broker_pid = None
+            index = self.children.pop(pid, None)
+            if index is not None:
+                dead.append(index)
+        return dead
+
+    def reload(self):
+        # The old workers stop accepting while the new ones start: the pending
+        # connections wait in the shared socket queue.
+        self.log("Reloading workers.")
+        old = list(self.children)
+        for index in range(self.workers):
+            self.spawn(index)
+        self.kill(old)
+
+    def stop(self):
+        self.log("Stopping workers.")
+        self.kill(list(self.children))
+        deadline = time.monotonic() + self.grace + 5
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(list(self.children), signal.SIGKILL)
+        self.reap()
+        if self.broker_pid:
+            # Stopped last, for the workers to publish until the end.
+            self.kill([self.broker_pid])
+            try:
+                os.waitpid(self.broker_pid, 0)
+            except ChildProcessError:
+                pass
+            self.broker_pid = None
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        self.bind()
+        mode = ", SO_REUSEPORT" if self.reuseport else ""
+        self.log(
+            f"Rolling on http://{self.host}:{self.port} ({self.workers} workers{mode})"
+        )
+        # Signals handlers only store the signal, and wake up the main loop.
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self.on_signal)
+        if self.broker:
+            # Inherited by the workers, see `roll.channels.Channels`.
+            os.environ["ROLL_BROKER"] = self.broker
+            self.broker_pid = self.spawn_broker()
+        preload(self.app)
+        for index in range(self.workers):
+            self.spawn(index)
+        try:
+            while True:
+                select.select([self.wakeup[0]], [], [], 1.0)
+                try:
+                    os.read(self.wakeup[0], 1024)
+                except BlockingIOError:
+                    pass
+                signals, self.signals = self.signals, []
+                if signal.SIGTERM in signals or signal.SIGINT in signals:
+                    break
+                if signal.SIGHUP in signals:
+                    self.reload()
+                dead = self.reap()
+                if self.broker and self.broker_pid is None:
+                    self.log("Broker died, restarting it.")
+                    self.broker_pid = self.spawn_broker()
+                for index in dead:
+                    if index not in self.children.values():
+                        self.log(f"Worker {index} died, restarting it.")
+                        time.sleep(1)  # Do not spin if it dies at startup.
+                        self.spawn(index)
+        finally:
+            self.stop()
+            signal.set_wakeup_fd(-1)
+            for fd in self.wakeup:
+                os.close(fd)
+            self.socket.close()
+
+
+def serve(app, host="127.0.0.1", port=3579, workers=None, **kwargs):
+    Master(app, host, port, workers, **kwargs).run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m roll.serve", description=__doc__)
+    parser.add_argument("app", help="app to serve, as module:attribute")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3579)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the number of CPUs"
+    )
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument(
+        "--grace", type=float, default=30, help="seconds to drain on shutdown"
+    )
+    parser.add_argument("--pin", action="store_true", help="pin each worker to a CPU")
+    parser.add_argument(
+        "--gc-threshold",
+        type=parse_gc_threshold,
+        help="GC thresholds for the workers, eg. 50000,20,100",
+    )
+    parser.add_argument("--broker", help="unix socket path of a channels broker")
+    parser.add_argument(
+        "--reuseport",
+        action="store_true",
+        help="one SO_REUSEPORT socket per worker, balanced by the kernel",
+    )
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+    serve(
+        load_app(args.app),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        backlog=args.backlog,
+        grace=args.grace,
+        pin=args.pin,
+        gc_threshold=args.gc_threshold,
+        quiet=args.quiet,
+        broker=args.broker,
+        reuseport=args.reuseport,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Server-Sent Events.
+
+An `EventSource` encodes each published event once, and pushes the same bytes
+to all its streams (the bodies of the `text/event-stream` responses):
+
+    source = EventSource()
+
+    @app.route("/events")
+    async def events(request, response):
+        response.sse = source
+
+    source.publish({"cpu": 12}, event="stats")
+"""
+
+import asyncio
+import os
+from collections import deque
+
+from .io import json
+
+# Pre-encoded field prefixes.
+DATA = b"data: "
+EVENT = b"event: "
+ID = b"id: "
+RETRY = b"retry: "
+EOL = b"\n"
+HEARTBEAT = b":\n\n"  # A comment, ignored by the clients.
+
+
+def encode(data=None, event: str = None, id=None, retry: int = None):
+    """Encode an event: `data` can be `bytes`, `str`, or anything JSON
+    serializable; multiline data is sent as multiple `data` fields."""
+    parts = []
+    if event:
+        parts.extend((EVENT, _field(event), EOL))
+    if id is not None:
+        parts.extend((ID, _field(id), EOL))
+    if retry is not None:
+        parts.extend((RETRY, b"%d" % retry, EOL))
+    if data is not None:
+        if not isinstance(data, (bytes, str)):
+            data = json.dumps(data)
+        if isinstance(data, str):
+            data = data.encode()
+        for line in data.splitlines() or [b""]:
+            parts.extend((DATA, line, EOL))
+    parts.append(EOL)
+    return b"".join(parts)
+
+
+def _field(value):
+    value = str(value).encode()
+    if b"\n" in value or b"\r" in value:
+        raise ValueError(f"Invalid event field: {value!r}")
+    return value
+
+
+class EventStream:
+    """Body of a `text/event-stream` response, fed by an `EventSource`.
+
+    The stream is only subscribed to its source once the body is iterated
+    (so not for a `HEAD` request, nor when the view fails). The events pushed
+    meanwhile the previous chunk was written are sent as one chunk.
+    """
+
+    __slots__ = (
+        "source",
+        "transport",
+        "last_event_id",
+        "pending",
+        "waiter",
+        "closed",
+    )
+
+    def __init__(self, source, transport, last_event_id: str = None):
+        self.source = source
+        self.transport = transport
+        self.last_event_id = last_event_id
+        self.pending = []
+        self.waiter = None
+        self.closed = False
+
+    def push(self, data: bytes):
+        if self.closed:
+            return
+        if self.transport.is_closing():
+            self.close()
+        elif (
+            self.transport.get_write_buffer_size() > self.source.max_buffer
+            or len(self.pending) >= self.source.max_pending
+        ):
+            # Slow consumer: end the response, the client will reconnect
+            # with its Last-Event-ID.
+            self.source.dropped += 1
+            self.close()
+        else:
+            self.pending.append(data)
+            self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self):
+        self.closed = True
+        self.source.unsubscribe(self)
+        self.wake()
+
+    def __aiter__(self):
+        if not self.closed:
+            self.source.subscribe(self)
+        return self
+
+    async def __anext__(self):
+        try:
+            while not self.pending:
+                if self.closed:
+                    raise StopAsyncIteration
+                self.waiter = asyncio.get_event_loop().create_future()
+                try:
+                    await self.waiter
+                finally:
+                    self.waiter = None
+        except BaseException:
+            # Ended or cancelled: do not receive events anymore.
+            self.close()
+            raise
+        data = b"".join(self.pending)
+        self.pending = []
+        return data
+
+    async def aclose(self):
+        self.close()
+
+
+class EventSource:
+    """Publish events to many `EventStream`s.
+
+    The last `history` events are kept to be replayed to the clients
+    reconnecting with a `Last-Event-ID` header. A comment is sent to all
+    streams every `heartbeat` seconds, by one shared timer, to keep the
+    connections open through the proxies. Streams whose transport buffers
+    more than `max_buffer` bytes, or with `max_pending` events not yet
+    written, are ended.
+    """
+
+    def __init__(
+        self,
+        history: int = 100,
+        heartbeat: float = 15,
+        max_buffer: int = 2**20,
+        retry: int = None,
+        max_pending: int = 1000,
+    ):
+        self.history = deque(maxlen=history)
+        self.heartbeat = heartbeat
+        self.max_buffer = max_buffer
+        self.max_pending = max_pending
+        self.retry = retry
+        self.streams = set()
+        self.channels = None  # Channels and channel name, when relayed.
+        self.last_id = 0
+        self.dropped = 0
+        self._timer = None
+
+    def publish(self, data=None, event: str = None, id=None):
+        """Encode an event once and push it to all the streams (of all the
+        workers, when relayed). Returns the encoded event."""
+        if id is None:
+            self.last_id += 1
+            id = self.last_id
+            if self.channels is not None:
+                # Unique between the workers, and their restarts.
+                id = f"{os.getpid()}-{id}"
+        id = str(id)
+        encoded = encode(data, event, id)
+        if self.channels is None:
+            self.push(id, encoded)
+        else:
+            # Delivered back to this source by the channel.
+            channels, channel = self.channels
+            channels.publish(channel, b"%b\n%b" % (id.encode(), encoded))
+        return encoded
+
+    def push(self, id: str, encoded: bytes):
+        self.history.append((id, encoded))
+        for stream in list(self.streams):
+            stream.push(encoded)
+
+    def relay(self, channels, channel: str):
+        """Share the events between the sources of all the workers, through
+        `channels`: the events keep the id given by the publishing worker,
+        so a client can reconnect to any worker with its Last-Event-ID."""
+        self.channels = channels, channel
+
+        def push(channel, message):
+            id, _, encoded = message.partition(b"\n")
+            self.push(id.decode(), encoded)
+
+        channels.subscribe(channel, push)
+
+    def replay(self, last_event_id: str):
+        """Return the events following `last_event_id`, or all the history if
+        it's unknown (too old)."""
+        events = list(self.history)
+        for index in range(len(events) - 1, -1, -1):
+            if events[index][0] == last_event_id:
+                return [encoded for _, encoded in events[index + 1 :]]
+        return [encoded for _, encoded in events]
+
+    def stream(self, transport, last_event_id: str = None):
+        """Return a response body, subscribed once iterated."""
+        return EventStream(self, transport, last_event_id)
+
+    def subscribe(self, stream: EventStream):
+        if self.retry is not None:
+            stream.pending.append(encode(retry=self.retry))
+        if stream.last_event_id is not None:
+            stream.pending.extend(self.replay(stream.last_event_id))
+        self.streams.add(stream)
+        if self._timer is None and self.heartbeat:
+            self._timer = asyncio.get_event_loop().call_later(self.heartbeat, self.beat)
+        return stream
+
+    def unsubscribe(self, stream: EventStream):
+        self.streams.discard(stream)
+        if not self.streams and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def beat(self):
+        for stream in list(self.streams):
+            stream.push(HEARTBEAT)
+        if self.streams:
+            self._timer = asyncio.get_event_loop().call_later(self.heartbeat, self.beat)
+        else:
+            self._timer = None
+
+    def close(self):
+        """End all the streams."""
+        for stream in list(self.streams):
+            stream.close()
@@ -81,9 +81,17 @@ class Transport:
     def write(self, data):
         self.data += data
 
+    def get_write_buffer_size(self):
+        return 0
+
     def close(self):
         self._closing = True
 
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return ("127.0.0.1", 0)
+        return default
+
     def pause_reading(self):
         pass
 
@@ -2,16 +2,81 @@ import asyncio
 
 import websockets
 from websockets import ConnectionClosed  # exposed for convenience
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.framing import OP_CONT
+from websockets.server import WebSocketServerProtocol
+
+
+class CompressionExtension(PerMessageDeflate):
+    """permessage-deflate, leaving messages smaller than `min_size` alone.
+
+    For a fragmented message, the size of its first frame decides for all
+    its frames, and only the first one has RSV1 set (RFC 7692).
+    """
+
+    min_size = 0
+    uncompressed = False  # Current message.
+
+    def encode(self, frame):
+        if frame.opcode != OP_CONT:
+            self.uncompressed = len(frame.data) < self.min_size
+        if self.uncompressed:
+            # Allowed by RFC 7692: the message is sent without RSV1.
+            return frame
+        if frame.opcode == OP_CONT:
+            return super().encode(frame)._replace(rsv1=False)
+        return super().encode(frame)
+
+
+class CompressionFactory(ServerPerMessageDeflateFactory):
+    def __init__(
+        self,
+        server_max_window_bits=None,
+        client_max_window_bits=None,
+        server_no_context_takeover=False,
+        client_no_context_takeover=False,
+        memory_level=None,
+        min_size=0,
+    ):
+        compress_settings = None
+        if memory_level is not None:
+            compress_settings = {"memLevel": memory_level}
+        super().__init__(
+            server_no_context_takeover=server_no_context_takeover,
+            client_no_context_takeover=client_no_context_takeover,
+            server_max_window_bits=server_max_window_bits,
+            client_max_window_bits=client_max_window_bits,
+            compress_settings=compress_settings,
+        )
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        params, extension = super().process_request_params(params, accepted_extensions)
+        # Same attributes: do not allocate the zlib objects again.
+        extension.__class__ = CompressionExtension
+        extension.min_size = self.min_size
+        return params, extension
 
 
 class WSProtocol(websockets.WebSocketCommonProtocol):
     NEEDS_UPGRADE = True
     ALLOWED_METHODS = {"GET"}
     TIMEOUT = 5
+    # Size limits, can be overridden with the route parameters of the same
+    # name (lowercased).
     MAX_SIZE = 2**20  # 1 megabytes
     MAX_QUEUE = 64
     READ_LIMIT = 2**16
     WRITE_LIMIT = 2**16
+    # Per connection keepalive pings, in seconds (None to disable).
+    PING_INTERVAL = 20
+    PING_TIMEOUT = 20
+    # permessage-deflate settings (True for defaults, or a dict), can be
+    # overridden with the `compression` route parameter.
+    COMPRESSION = None
 
     is_client = False
     side = "server"  # Useful for websockets logging.
@@ -20,10 +85,38 @@ class WSProtocol(websockets.WebSocketCommonProtocol):
         self.request = request
         super().__init__(
             timeout=self.TIMEOUT,
-            max_size=self.MAX_SIZE,
-            max_queue=self.MAX_QUEUE,
-            read_limit=self.READ_LIMIT,
-            write_limit=self.WRITE_LIMIT,
+            ping_interval=self.PING_INTERVAL,
+            ping_timeout=self.PING_TIMEOUT,
+            **self.limits(request.route.payload),
+        )
+
+    @classmethod
+    def limits(cls, payload: dict = None):
+        """Return the size limits of a route, given its payload."""
+        payload = payload or {}
+        return {
+            "max_size": payload.get("max_size", cls.MAX_SIZE),
+            "max_queue": payload.get("max_queue", cls.MAX_QUEUE),
+            "read_limit": payload.get("read_limit", cls.READ_LIMIT),
+            "write_limit": payload.get("write_limit", cls.WRITE_LIMIT),
+        }
+
+    @classmethod
+    def max_memory(cls, payload: dict = None):
+        """Estimate the memory, in bytes, a connection of a route can use in
+        the worst case for its buffers (None if unbounded).
+
+        That is: `max_queue` received messages waiting to be consumed, plus
+        the one being read, of `max_size` bytes each, the read buffer (paused
+        at `read_limit`) and the write buffer (`write_limit`).
+        """
+        limits = cls.limits(payload)
+        if limits["max_size"] is None or limits["max_queue"] is None:
+            return None
+        return (
+            limits["max_size"] * (limits["max_queue"] + 1)
+            + limits["read_limit"]
+            + limits["write_limit"]
         )
 
     def handshake(self, response):
@@ -50,6 +143,16 @@ class WSProtocol(websockets.WebSocketCommonProtocol):
         # Return the subprotocol agreed upon, if any
         self.subprotocol = subprotocol
 
+        compression = self.request.route.payload.get("compression", self.COMPRESSION)
+        if compression:
+            if compression is True:
+                compression = {}
+            header, self.extensions = WebSocketServerProtocol.process_extensions(
+                headers, [CompressionFactory(**compression)]
+            )
+            if header is not None:
+                response.headers["Sec-WebSocket-Extensions"] = header
+
     async def run(self):
         # See https://tools.ietf.org/html/rfc6455#page-45
         try:
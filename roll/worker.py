@@ -1,5 +1,7 @@
 import asyncio
+import gc
 import os
+import signal
 import socket
 import sys
 
@@ -11,12 +13,85 @@ except ImportError:
 
     warnings.warn("You should install uvloop for better performance")
 
+from gunicorn.config import Setting, validate_pos_int, validate_string
 from gunicorn.workers.base import Worker
 
+from .serve import format_memory, memory_usage, parse_gc_threshold, preload
+
+# Gunicorn settings must be known before the command line and config file are
+# parsed, so they are only available when running through `python -m roll.worker`
+# (this module is thus not compiled, see setup.py).
+# No TCP_NODELAY setting: asyncio sets it on every accepted TCP connection.
+
+
+class TcpDeferAccept(Setting):
+    name = "tcp_defer_accept"
+    section = "Roll"
+    cli = ["--tcp-defer-accept"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        Seconds during which the connection is only accepted once data has been
+        received (TCP_DEFER_ACCEPT, Linux only). 0 to disable.
+        """
+
+
+class TcpFastOpen(Setting):
+    name = "tcp_fastopen"
+    section = "Roll"
+    cli = ["--tcp-fastopen"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        Length of the TCP_FASTOPEN queue of TCP listening sockets. 0 to disable.
+        """
+
+
+class GcThreshold(Setting):
+    name = "gc_threshold"
+    section = "Roll"
+    cli = ["--gc-threshold"]
+    meta = "STRING"
+    validator = validate_string
+    default = None
+    desc = """\
+        Comma separated GC thresholds for the workers (see gc.set_threshold),
+        eg. 50000,20,100.
+        """
+
+
+DEFAULTS = {
+    s.name: s.default for s in (TcpDeferAccept, TcpFastOpen, GcThreshold)
+}
+
 
 class Worker(Worker):
+    preloaded = False  # In the arbiter.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Instantiated by the arbiter right before forking: prepare the app
+        # once, not for every worker spawned.
+        if self.cfg.preload_app and not Worker.preloaded:
+            preload(self.app.wsgi())
+            Worker.preloaded = True
+
+    def setting(self, name):
+        try:
+            return getattr(self.cfg, name)
+        except AttributeError:
+            # Gunicorn has not been run through `python -m roll.worker`.
+            return DEFAULTS[name]
+
     def init_process(self):
-        self.server = None
+        self.servers = []
+        gc_threshold = self.setting("gc_threshold")
+        if gc_threshold:
+            gc.set_threshold(*parse_gc_threshold(gc_threshold))
         asyncio.get_event_loop().close()
         if uvloop:
             uvloop.install()
@@ -24,6 +99,13 @@ class Worker(Worker):
         asyncio.set_event_loop(self.loop)
         super().init_process()
 
+    def init_signals(self):
+        super().init_signals()
+        signal.signal(signal.SIGUSR2, self.log_memory)
+
+    def log_memory(self, *args):
+        self.log.info("Memory: %s: %s", format_memory(memory_usage()), self.pid)
+
     def run(self):
         self.wsgi.loop = self.loop
         self.loop.run_until_complete(self.wsgi.startup())
@@ -34,24 +116,49 @@ class Worker(Worker):
         sys.exit()
 
     async def close(self):
-        if self.server:
-            server = self.server
-            self.server = None
+        if self.servers:
+            servers = self.servers
+            self.servers = []
             self.log.info("Stopping server: %s", self.pid)
+            # Stop accepting new connections, then let the current ones end.
+            for server in servers:
+                server.close()
+            # Keep a margin before being killed by the arbiter.
+            grace = max(self.cfg.graceful_timeout - 2, 0)
+            drained, killed = await self.wsgi.drain(grace)
+            self.log.info(
+                "Drained %s request(s), killed %s: %s", drained, killed, self.pid
+            )
             await self.wsgi.shutdown()
-            server.close()
-            await server.wait_closed()
+            for server in servers:
+                await server.wait_closed()
+
+    def tune(self, sock):
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        defer_accept = self.setting("tcp_defer_accept")
+        if defer_accept and hasattr(socket, "TCP_DEFER_ACCEPT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, defer_accept)
+        fastopen = self.setting("tcp_fastopen")
+        if fastopen and hasattr(socket, "TCP_FASTOPEN"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, fastopen)
 
     async def _run(self):
-        sock = self.sockets[0]
-        if hasattr(socket, "AF_UNIX") and sock.family == socket.AF_UNIX:
-            self.server = await self.loop.create_unix_server(
-                self.wsgi.factory, sock=sock.sock
-            )
-        else:
-            self.server = await self.loop.create_server(
-                self.wsgi.factory, sock=sock.sock
-            )
+        self.log_memory()
+        for listener in self.sockets:
+            sock = listener.sock
+            # asyncio would otherwise call listen() again with its own default.
+            backlog = self.cfg.backlog
+            if hasattr(socket, "AF_UNIX") and sock.family == socket.AF_UNIX:
+                server = await self.loop.create_unix_server(
+                    self.wsgi.factory, sock=sock, backlog=backlog
+                )
+            else:
+                self.tune(sock)
+                server = await self.loop.create_server(
+                    self.wsgi.factory, sock=sock, backlog=backlog
+                )
+            self.servers.append(server)
 
         pid = os.getpid()
         try:
@@ -66,3 +173,11 @@ class Worker(Worker):
             print(e)
 
         await self.close()
+
+
+if __name__ == "__main__":
+    from gunicorn.app.wsgiapp import WSGIApplication
+
+    sys.argv[0] = "roll.worker"
+    sys.argv[1:1] = ["--worker-class", "roll.worker.Worker"]
+    WSGIApplication("%(prog)s [OPTIONS] [APP_MODULE]").run()
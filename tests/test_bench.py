@@ -0,0 +1,64 @@
+import json
+from http import HTTPStatus
+
+import pytest
+
+from roll import bench
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_hdr_bounds():
+    bounds = bench.hdr_bounds(0.001, 1, 0.1)
+    assert bounds[0] == 0.001
+    assert bounds[-1] >= 1
+    assert all(b / a == pytest.approx(1.1) for a, b in zip(bounds, bounds[1:]))
+
+
+async def test_load_scenario(tmp_path):
+    path = tmp_path / "scenario.json"
+    path.write_text(json.dumps([
+        {"path": "/foo"},
+        {"method": "POST", "path": "/bar", "body": {"key": "value"}},
+    ]))
+    requests = bench.load_scenario(path)
+    assert requests == [
+        ("GET", "/foo", {}, None),
+        ("POST", "/bar", {}, {"key": "value"}),
+    ]
+    assert bench.encode_request("localhost", *requests[1]) == (
+        b"POST /bar HTTP/1.1\r\nHost: localhost\r\n"
+        b"Content-Type: application/json\r\nContent-Length: 16\r\n\r\n"
+        b'{"key": "value"}'
+    )
+
+
+async def test_run(liveclient):
+
+    @liveclient.app.route('/test')
+    async def get(req, resp):
+        resp.body = 'test response'
+
+    results = await bench.run(liveclient.url + '/test', connections=2,
+                              duration=0.2, pipeline=2)
+    assert results.count > 10
+    assert results.statuses == {HTTPStatus.OK: results.count}
+    assert results.errors == 0
+    assert results.throughput > 0
+    assert 0 < results.histogram.quantile(0.5) < 0.2
+    assert 'Requests/sec' in results.report()
+
+
+async def test_run_scenario(liveclient):
+
+    @liveclient.app.route('/test/{id}', methods=['GET', 'POST'])
+    async def get(req, resp, id):
+        if req.method == 'POST':
+            resp.status = HTTPStatus.CREATED
+
+    results = await bench.run(
+        liveclient.url,
+        [("GET", "/test/1", None, None), ("POST", "/test/2", None, "foo"),
+         ("GET", "/unknown", None, None)],
+        connections=1, duration=0.1)
+    assert set(results.statuses) == {200, 201, 404}
@@ -0,0 +1,234 @@
+import asyncio
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+import websockets
+
+from roll.channels import (PUBLISH, SUBSCRIBE, UNSUBSCRIBE, Broker, Channels,
+                           Link, decode_frame, encode_frame, spawn_broker)
+from roll.testing import Transport
+from roll.extensions import websockets_store
+from roll.sse import EventSource
+
+APP = """
+import os
+from roll import Roll
+from roll.extensions import channels
+
+app = Roll()
+layer = channels(app)
+received = []
+layer.subscribe("news", lambda channel, message: received.append(message))
+
+@app.route("/", methods=["GET", "POST"])
+async def news(request, response):
+    if request.method == "POST":
+        layer.publish("news", request.body.decode())
+    response.json = {"pid": os.getpid(), "received": received}
+"""
+
+
+@pytest.fixture
+def broker(event_loop, tmp_path):
+    broker = Broker(str(tmp_path / "broker.sock"))
+    event_loop.run_until_complete(broker.start())
+    yield broker
+    event_loop.run_until_complete(broker.stop())
+
+
+async def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_frames():
+    frame = encode_frame(PUBLISH, 'news', 'héllo')
+    assert decode_frame(frame) == (PUBLISH, 'news', 'héllo')
+    assert decode_frame(encode_frame(PUBLISH, 'news', b'\x00\x01')) == (
+        PUBLISH, 'news', b'\x00\x01')
+    assert decode_frame(encode_frame(SUBSCRIBE, 'news')) == (
+        SUBSCRIBE, 'news', b'')
+
+
+@pytest.mark.asyncio
+async def test_link_never_drops_subscriptions():
+    link = Link(lambda link, frame: None, max_buffer=10)
+    link.connection_made(Transport())
+    link.transport.get_write_buffer_size = lambda: 11
+    link.send(encode_frame(SUBSCRIBE, 'news'))
+    link.send(encode_frame(PUBLISH, 'news', 'dropped'))
+    link.send(encode_frame(UNSUBSCRIBE, 'other'))
+    link.flush()
+    assert link.transport.data == (
+        encode_frame(SUBSCRIBE, 'news') + encode_frame(UNSUBSCRIBE, 'other'))
+    assert link.dropped == 1
+
+
+def test_spawn_broker_closes_fds(tmp_path):
+    read, write = os.pipe()
+    pid = spawn_broker(str(tmp_path / 'broker.sock'), close_fds=[write])
+    try:
+        os.close(write)
+        # No process left with the write end open.
+        assert os.read(read, 1) == b''
+    finally:
+        os.close(read)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def test_local_channels():
+    layer = Channels()
+    received = []
+
+    def callback(channel, message):
+        received.append((channel, message))
+
+    layer.subscribe('news', callback)
+    layer.publish('news', 'first')
+    layer.publish('other', 'ignored')
+    layer.unsubscribe('news', callback)
+    layer.publish('news', 'second')
+    assert received == [('news', 'first')]
+    assert not layer.subscribers
+    assert not layer.dropped
+
+
+@pytest.mark.asyncio
+async def test_channels_through_broker(broker):
+    first, second = Channels(broker.path), Channels(broker.path)
+    await first.connect()
+    await second.connect()
+    received = {'first': [], 'second': []}
+    first.subscribe(
+        'news', lambda channel, message: received['first'].append(message))
+    second.subscribe(
+        'news', lambda channel, message: received['second'].append(message))
+    await wait_for(lambda: len(broker.subscribers[b'news']) == 2)
+
+    writes = []
+    write = first.link.transport.write
+    first.link.transport.write = lambda data: writes.append(write(data))
+    for i in range(3):
+        first.publish('news', f'message {i}')
+    first.publish('news', b'binary')
+    await wait_for(lambda: len(received['second']) == 4)
+    assert received['first'] == received['second'] == [
+        'message 0', 'message 1', 'message 2', b'binary']
+    # Batched in one write.
+    assert len(writes) == 1
+
+    # Not subscribed: not sent by the broker.
+    second.publish('other', 'ignored')
+    second.close()
+    await wait_for(lambda: b'news' not in broker.subscribers
+                   or len(broker.subscribers[b'news']) == 1)
+    first.close()
+    await wait_for(lambda: not broker.subscriptions)
+    assert received['first'] == [
+        'message 0', 'message 1', 'message 2', b'binary']
+
+
+@pytest.mark.asyncio
+async def test_channels_reconnect(broker):
+    layer = Channels(broker.path)
+    layer.RECONNECT_DELAY = 0.01
+    layer.subscribe('news', lambda channel, message: None)
+    await layer.connect()
+    await wait_for(lambda: b'news' in broker.subscribers)
+    await broker.stop()
+    layer.link.transport.close()
+    await wait_for(lambda: layer.link is None)
+    layer.publish('news', 'lost')
+    assert layer.dropped == 1
+    await broker.start()
+    # Subscriptions are sent again.
+    await wait_for(lambda: b'news' in broker.subscribers)
+    layer.close()
+
+
+@pytest.mark.asyncio
+async def test_websockets_store_relay(app, liveclient):
+    layer = Channels()
+    store = websockets_store(app)
+    store.relay(layer, 'chat')
+
+    @app.route('/chat', protocol="websocket")
+    async def chat(request, ws):
+        await ws.wait_closed()
+
+    websocket = await websockets.connect(liveclient.wsl + '/chat')
+    try:
+        await wait_for(lambda: len(store) == 1)
+        layer.publish('chat', 'hello')
+        assert await websocket.recv() == 'hello'
+    finally:
+        await websocket.close()
+
+
+def test_event_source_relay():
+    layer = Channels()
+    # Sources of two workers.
+    first, second = EventSource(), EventSource()
+    first.relay(layer, 'stats')
+    second.relay(layer, 'stats')
+    second.publish({'cpu': 12})
+    second.publish({'cpu': 14})
+    pid = os.getpid()
+    # Same ids in all the workers, given by the publisher.
+    assert list(first.history) == list(second.history) == [
+        (f'{pid}-1', f'id: {pid}-1\ndata: {{"cpu": 12}}\n\n'.encode()),
+        (f'{pid}-2', f'id: {pid}-2\ndata: {{"cpu": 14}}\n\n'.encode()),
+    ]
+    assert not first.last_id
+
+
+def test_serve_with_broker(tmp_path, monkeypatch, unused_tcp_port):
+    (tmp_path / "channelsapp.py").write_text(APP)
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "broker.sock")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "roll.serve", "channelsapp:app", "--workers",
+         "2", "--port", str(unused_tcp_port), "--broker", path, "--quiet"],
+        env={**os.environ,
+             "PYTHONPATH": os.pathsep.join([os.getcwd(), *sys.path])},
+    )
+
+    def query(method="GET", body=None):
+        conn = http.client.HTTPConnection(
+            "127.0.0.1", unused_tcp_port, timeout=5)
+        conn.request(method, "/", body=body)
+        data = json.loads(conn.getresponse().read())
+        conn.close()
+        return data
+
+    try:
+        # Wait for both workers to serve (they connect to the broker before).
+        pids = set()
+        deadline = time.monotonic() + 10
+        while len(pids) < 2:
+            assert time.monotonic() < deadline
+            try:
+                pids.add(query()["pid"])
+            except OSError:
+                time.sleep(0.1)
+        query("POST", "hello")
+        seen = {}
+        while len(seen) < 2 or [] in seen.values():
+            assert time.monotonic() < deadline
+            data = query()
+            seen[data["pid"]] = data["received"]
+        # Both workers received the message.
+        assert list(seen.values()) == [["hello"], ["hello"]]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+    assert not os.path.exists(path)
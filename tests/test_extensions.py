@@ -1,9 +1,15 @@
+import asyncio
+import io
 import json
+import marshal
+import sys
+import time
 from http import HTTPStatus
 from pathlib import Path
 
 import pytest
-from roll import extensions
+from roll import HttpError, extensions
+from roll.testing import Client, Transport
 
 pytestmark = pytest.mark.asyncio
 
@@ -345,3 +351,643 @@ async def test_can_call_static_twice(client, app):
     await app.startup()
     assert url_for("statics", path="myfile.png") == "/static/myfile.png"
     assert url_for("medias", path="myfile.mp3") == "/medias/myfile.mp3"
+
+
+async def test_ratelimit(client, app):
+
+    extensions.ratelimit(app, rate=1, burst=2)
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.body = 'test response'
+
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.TOO_MANY_REQUESTS
+    assert resp.headers['Retry-After'] == '1'
+
+
+async def test_ratelimit_is_per_key(client, app):
+
+    extensions.ratelimit(app, rate=1, burst=1, key='X-Api-Key')
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.body = 'test response'
+
+    resp = await client.get('/test', headers={'X-Api-Key': 'foo'})
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get('/test', headers={'X-Api-Key': 'foo'})
+    assert resp.status == HTTPStatus.TOO_MANY_REQUESTS
+    resp = await client.get('/test', headers={'X-Api-Key': 'bar'})
+    assert resp.status == HTTPStatus.OK
+    # No key, no limit.
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+
+
+async def test_ratelimit_does_not_consume_body(client, app):
+
+    extensions.ratelimit(app, rate=1, burst=1, key=lambda req: 'all')
+
+    @app.route('/test', methods=['POST'])
+    async def post(req, resp):
+        resp.body = req.body
+
+    resp = await client.post('/test', body=b'foo')
+    assert resp.status == HTTPStatus.OK
+    assert resp.body == b'foo'
+    resp = await client.post('/test', body=b'foo')
+    assert resp.status == HTTPStatus.TOO_MANY_REQUESTS
+    assert client.protocol.request._body is None
+
+
+async def test_ratelimit_per_route(client, app):
+
+    extensions.ratelimit(app, rate=1, burst=1)
+
+    @app.route('/limited', ratelimit=(1, 2))
+    async def limited(req, resp):
+        resp.body = 'limited'
+
+    @app.route('/unlimited', ratelimit=None)
+    async def unlimited(req, resp):
+        resp.body = 'unlimited'
+
+    for _ in range(3):
+        resp = await client.get('/unlimited')
+        assert resp.status == HTTPStatus.OK
+    resp = await client.get('/limited')
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get('/limited')
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get('/limited')
+    assert resp.status == HTTPStatus.TOO_MANY_REQUESTS
+
+
+async def test_token_buckets_refill_and_eviction():
+    buckets = extensions.TokenBuckets(rate=2, burst=2)
+    assert buckets.consume('foo', now=0) == 0
+    assert buckets.consume('foo', now=0) == 0
+    assert buckets.consume('foo', now=0) == 0.5
+    assert buckets.consume('foo', now=0.5) == 0
+    assert buckets.consume('bar', now=0.5) == 0
+    assert len(buckets) == 2
+    buckets.evict(now=1)
+    # foo is not full yet.
+    assert list(buckets.slots) == ['foo']
+    buckets.evict(now=2)
+    assert len(buckets) == 0
+    # Slots are reused.
+    buckets.consume('baz', now=2)
+    assert len(buckets.tokens) == 2
+
+
+async def test_token_buckets_eviction_by_batches():
+    buckets = extensions.TokenBuckets(rate=1, burst=1)
+    for key in range(5):
+        buckets.consume(key, now=0)
+    buckets.consume(2, now=9)
+    assert not buckets.evict(now=9.5, count=2)
+    assert list(buckets.slots) == [2, 3, 4]
+    assert not buckets.evict(now=9.5, count=2)
+    assert list(buckets.slots) == [2, 4]
+    # Done once the last slot has been checked, then starts over.
+    assert buckets.evict(now=9.5, count=2)
+    assert list(buckets.slots) == [2]
+    assert buckets.cursor == 0
+    assert buckets.evict(now=11)
+    assert not buckets.slots
+
+
+async def test_ratelimit_evicts_by_batches(client, app):
+    app.hooks['startup'] = []
+    buckets = extensions.ratelimit(app, rate=100, burst=1, key='X-Api-Key',
+                                   evict_every=0.01, evict_batch=2)
+
+    @app.route('/test')
+    async def get(req, resp):
+        pass
+
+    for key in range(5):
+        await client.get('/test', headers={'X-Api-Key': str(key)})
+    assert len(buckets) == 5
+    await app.startup()
+    seen = set()
+    deadline = time.monotonic() + 1
+    while buckets:
+        assert time.monotonic() < deadline
+        seen.add(len(buckets))
+        await asyncio.sleep(0)
+    # Not all at once: requests can be handled between the batches.
+    assert {5, 3, 1} <= seen
+    await app.shutdown()
+
+
+async def test_ratelimit_validates_rate_and_burst(app):
+    app.hooks['startup'] = []
+    with pytest.raises(ValueError):
+        extensions.ratelimit(app, rate=0)
+    with pytest.raises(ValueError):
+        extensions.ratelimit(app, rate=1, burst=0.5)
+    assert extensions.TokenBuckets(rate=0.5).burst == 1
+    assert extensions.TokenBuckets(rate=5).burst == 5
+    extensions.ratelimit(app, rate=1)
+    with pytest.raises(ValueError):
+        @app.route('/limited', ratelimit=(-1, 2))
+        async def limited(request, response):
+            pass
+
+
+async def test_load_shedding_rejects_over_max_inflight(client, app):
+
+    app.hooks['startup'] = []
+    shedder = extensions.load_shedding(app, max_inflight=1, retry_after=2)
+    await app.startup()
+    event = asyncio.Event()
+
+    @app.route('/test')
+    async def get(req, resp):
+        await event.wait()
+        resp.body = 'test response'
+
+    first = app.factory()
+    first.connection_made(Transport())
+    first.data_received(b'GET /test HTTP/1.1\r\n\r\n')
+    assert shedder.inflight == 1
+    second = app.factory()
+    second.connection_made(Transport())
+    second.data_received(b'GET /test HTTP/1.1\r\n\r\n')
+    assert second.transport.data.startswith(b'HTTP/1.1 503 ')
+    assert b'Retry-After: 2\r\n' in second.transport.data
+    assert second.transport.is_closing()
+    # No task has been created for the rejected request.
+    assert second.task is None
+    assert shedder.shed == 1
+    event.set()
+    await first.task
+    assert first.transport.data.startswith(b'HTTP/1.1 200 ')
+    assert shedder.inflight == 0
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    await app.shutdown()
+
+
+async def test_load_shedding_rejects_on_loop_lag(client, app):
+
+    app.hooks['startup'] = []
+    shedder = extensions.load_shedding(app, max_lag=0.5)
+    await app.startup()
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.body = 'test response'
+
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    shedder.lag = 1
+    await client.get('/test')
+    assert client.protocol.transport.data.startswith(b'HTTP/1.1 503 ')
+    await app.shutdown()
+
+
+async def test_load_shedder_adaptive_limit():
+    shedder = extensions.LoadShedder(adaptive=True, target=0.1, max_limit=10)
+    assert shedder.limit == 10
+    assert shedder.admit()
+    assert shedder.admit()
+    shedder.release(0, 1)
+    assert shedder.limit == 9
+    # Started before the decrease: same window, not decreased again.
+    shedder.release(0.5, 1.5)
+    assert shedder.limit == 9
+    for _ in range(9):
+        assert shedder.admit()
+    assert not shedder.admit()
+    shedder.release(1.5, 1.51)
+    assert shedder.limit == 9 + 1 / 9
+    shedder.release(1.5, 2)
+    assert shedder.limit == (9 + 1 / 9) * 0.9
+
+
+async def test_load_shedder_no_cap_by_default():
+    shedder = extensions.LoadShedder()
+    for _ in range(2000):
+        assert shedder.admit()
+
+
+async def test_load_shedding_releases_streamed_responses(client, app):
+
+    app.hooks['startup'] = []
+    shedder = extensions.load_shedding(app, max_inflight=1)
+    await app.startup()
+    event = asyncio.Event()
+
+    async def stream():
+        yield b'first'
+        await event.wait()
+
+    @app.route('/stream')
+    async def get(req, resp):
+        resp.body = stream()
+
+    protocol = app.factory()
+    protocol.connection_made(Transport())
+    protocol.data_received(b'GET /stream HTTP/1.1\r\n\r\n')
+    while b'first' not in protocol.transport.data:
+        await asyncio.sleep(0)
+    # The stream is still open, but does not count as in flight.
+    assert shedder.inflight == 0
+    event.set()
+    await protocol.task
+    assert shedder.inflight == 0
+    await app.shutdown()
+
+
+async def test_lag_monitor(client, app, caplog):
+
+    app.hooks['startup'] = []
+    monitor = extensions.lag_monitor(app, interval=0.005, threshold=0.05)
+    await app.startup()
+
+    @app.route('/blocking')
+    async def blocking(req, resp):
+        time.sleep(0.2)  # Blocking call.
+        resp.body = 'done'
+
+    await asyncio.sleep(0.02)
+    assert monitor.histogram.count > 0
+    resp = await client.get('/blocking')
+    assert resp.status == HTTPStatus.OK
+    await asyncio.sleep(0.01)
+    await app.shutdown()
+    assert monitor.stalls == 1
+    assert monitor.histogram.quantile(1) >= 0.1
+    record = caplog.records[-1]
+    assert 'Event loop blocked' in record.getMessage()
+    assert 'while handling GET /blocking' in record.getMessage()
+    assert 'time.sleep(0.2)' in record.getMessage()
+
+
+async def test_lag_monitor_in_created_task(client, app, caplog):
+
+    app.hooks['startup'] = []
+    monitor = extensions.lag_monitor(app, interval=0.005, threshold=0.05)
+    await app.startup()
+
+    async def block():
+        time.sleep(0.2)  # Blocking call, in another task.
+
+    @app.route('/blocking/{id}')
+    async def blocking(req, resp, id):
+        await asyncio.gather(block())
+
+    await client.get('/blocking/1')
+    await asyncio.sleep(0.01)
+    await app.shutdown()
+    assert monitor.stalls == 1
+    # The route, not the path.
+    assert 'while handling GET /blocking/{id}' in caplog.records[-1].getMessage()
+    assert app.loop.get_task_factory() is None
+
+
+async def test_lag_monitor_task_factory_arguments(client, app):
+
+    monitor = extensions.LagMonitor(app, 1, 1, None)
+
+    async def noop():
+        pass
+
+    # Eg. `context` on Python 3.11+.
+    task = monitor.create_task(app.loop, noop(), name='named')
+    assert task.get_name() == 'named'
+    await task
+
+
+async def test_metrics(client, app):
+
+    registry = extensions.metrics(app)
+
+    @app.route('/test/{id}', methods=['GET', 'POST'])
+    async def get(req, resp, id):
+        resp.body = 'test response'
+
+    @app.route('/error')
+    async def error(req, resp):
+        raise ValueError('Oops')
+
+    await client.get('/test/1')
+    await client.post('/test/2', body=b'foo')
+    await client.get('/error')
+    await client.get('/unknown')
+    resp = await client.get('/metrics')
+    assert resp.status == HTTPStatus.OK
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    lines = resp.body.decode().splitlines()
+    assert 'roll_requests_total{route="/test/{id}",status="2xx"} 2' in lines
+    assert 'roll_requests_total{route="/error",status="5xx"} 1' in lines
+    assert 'roll_requests_total{route="",status="4xx"} 1' in lines
+    assert ('roll_request_duration_seconds_bucket{route="/test/{id}",le="+Inf"} 2'
+            in lines)
+    assert 'roll_request_duration_seconds_count{route="/test/{id}"} 2' in lines
+    assert 'roll_request_bytes_total{route="/test/{id}"} 3' in lines
+    assert 'roll_response_bytes_total{route="/test/{id}"} 26' in lines
+    # The metrics request itself is in flight.
+    assert 'roll_requests_in_flight{route="/metrics"} 1' in lines
+    assert 'roll_requests_in_flight{route="/test/{id}"} 0' in lines
+    assert registry.data[registry.routes['/metrics'] + registry.inflight] == 0
+
+
+async def test_timings(client, app):
+
+    extensions.timings(app)
+    timings = []
+
+    @app.listen('timing')
+    async def on_timing(request, response):
+        timings.append(request.timings)
+
+    @app.listen('request')
+    async def on_request(request, response):
+        await asyncio.sleep(0.01)
+
+    @app.route('/test')
+    async def get(req, resp):
+        time.sleep(0.01)
+        resp.body = 'test response'
+
+    @app.listen('response')
+    async def on_response(request, response):
+        pass
+
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    assert 'Server-Timing' not in resp.headers
+    # Only the hooks with functions are timed.
+    assert list(timings[0]) == [
+        'lookup', 'parse', 'request', 'response', 'view', 'write', 'total']
+    assert timings[0]['request'] >= 0.01
+    assert timings[0]['view'] >= 0.01
+    assert timings[0]['total'] >= 0.02
+
+
+async def test_timings_keeps_other_hook_wrappers(client, app):
+
+    calls = []
+    hook = app.hook
+
+    async def wrapped_hook(name_, *args, **kwargs):
+        calls.append(name_)
+        return await hook(name_, *args, **kwargs)
+
+    app.hook = wrapped_hook
+    extensions.timings(app)
+    timings = []
+
+    @app.listen('timing')
+    async def on_timing(request, response):
+        timings.append(request.timings)
+
+    @app.listen('headers')
+    async def on_headers(request, response):
+        pass
+
+    @app.route('/test')
+    async def get(req, resp):
+        pass
+
+    await client.get('/test')
+    assert calls == ['headers', 'request', 'response', 'timing']
+    assert 'headers' in timings[0]
+
+
+async def test_timings_server_timing_header(client, app):
+
+    extensions.timings(app, server_timing=True)
+
+    @app.route('/test')
+    async def get(req, resp):
+        raise HttpError(HTTPStatus.BAD_REQUEST)
+
+    @app.listen('error')
+    async def on_error(request, response, error):
+        pass
+
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.BAD_REQUEST
+    names = [metric.split(';')[0]
+             for metric in resp.headers['Server-Timing'].split(', ')]
+    assert names == ['lookup', 'parse', 'error', 'view']
+
+
+async def test_access_log(client, app):
+
+    stream = io.StringIO()
+    log = extensions.access_log(app, stream=stream)
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.body = 'test response'
+
+    log.start()
+    await client.get('/test?foo=bar', headers={'User-Agent': 'Tester'})
+    await client.get('/unknown')
+    log.stop()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('127.0.0.1 - - [')
+    assert lines[0].endswith('] "GET /test?foo=bar HTTP/1.1" 200 13 "-" "Tester"')
+    assert lines[1].endswith('] "GET /unknown HTTP/1.1" 404 8 "-" "-"')
+    assert log.written == 2
+    assert log.dropped == 0
+
+
+async def test_access_log_json(client, app):
+
+    stream = io.StringIO()
+    log = extensions.access_log(app, stream=stream, format='json')
+
+    @app.route('/test', methods=['POST'])
+    async def post(req, resp):
+        resp.status = 201
+
+    log.start()
+    await client.post('/test', body=b'foo')
+    log.stop()
+    entry = json.loads(stream.getvalue())
+    assert entry['method'] == 'POST'
+    assert entry['url'] == '/test'
+    assert entry['status'] == 201
+    assert entry['bytes'] == 0
+    assert entry['duration'] > 0
+    assert entry['referrer'] is None
+
+
+async def test_access_log_drops_lines_when_queue_is_full(client, app):
+
+    stream = io.StringIO()
+    log = extensions.access_log(app, stream=stream, format='common',
+                                max_queue=1)
+
+    @app.route('/test')
+    async def get(req, resp):
+        pass
+
+    # Thread not started: the queue is never consumed.
+    await client.get('/test')
+    await client.get('/test')
+    assert log.dropped == 1
+    log.start()
+    log.stop()
+    assert stream.getvalue().endswith('] "GET /test HTTP/1.1" 200 0\n')
+    assert log.written == 1
+
+
+async def test_access_log_file(client, app, tmp_path):
+
+    app.hooks['startup'] = []
+    path = tmp_path / 'access.log'
+    log = extensions.access_log(app, stream=path, format='common')
+
+    @app.route('/test')
+    async def get(req, resp):
+        pass
+
+    await app.startup()
+    await client.get('/test')
+    log.queue.put(None)  # Not the last of its batch.
+    await client.get('/test')
+    await app.shutdown()
+    assert log.thread is None
+    assert log.stream.closed
+    assert path.read_text().endswith('] "GET /test HTTP/1.1" 200 0\n')
+    assert log.written == 1
+
+
+async def test_access_log_unknown_format(app):
+    with pytest.raises(ValueError):
+        extensions.access_log(app, format='foo')
+
+
+async def test_profiler_samples_requests(client, app):
+
+    profiler = extensions.profiler(app, rate=1)
+
+    def slow_function():
+        return sum(range(1000))
+
+    @app.route('/test/{id}')
+    async def get(req, resp, id):
+        resp.body = str(slow_function())
+
+    await client.get('/test/1')
+    await client.get('/test/2')
+    assert list(profiler.stats) == ['/test/{id}']
+    assert sys.getprofile() is None
+    text = profiler.text('/test/{id}')
+    assert 'slow_function' in text
+    stats = marshal.loads(profiler.dump('/test/{id}'))
+    calls = [v[1] for k, v in stats.items() if k[2] == 'slow_function']
+    assert calls == [2]
+
+
+async def test_profiler_with_deadline(client, app):
+
+    app.TIMEOUT = 5
+    profiler = extensions.profiler(app, rate=1)
+
+    def slow_function():
+        return sum(range(1000))
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.body = str(slow_function())
+
+    resp = await client.get('/test')
+    assert resp.status == HTTPStatus.OK
+    # The view runs in the request task, it is profiled.
+    assert 'slow_function' in profiler.text('/test')
+    assert sys.getprofile() is None
+
+
+async def test_profiler_ignores_concurrent_requests(client, app):
+
+    profiler = extensions.profiler(app, rate=0, header='X-Profile',
+                                   secret='s3cr3t')
+    event = asyncio.Event()
+
+    def other_route_work():
+        return sum(range(1000))
+
+    @app.route('/slow')
+    async def slow(req, resp):
+        await event.wait()
+
+    @app.route('/other')
+    async def other(req, resp):
+        other_route_work()
+        event.set()
+
+    slow_client, other_client = Client(app), Client(app)
+    slow_request = asyncio.ensure_future(slow_client.get(
+        '/slow', headers={'X-Profile': profiler.sign('/slow')}))
+    await asyncio.sleep(0)
+    await other_client.get('/other')
+    await slow_request
+    assert list(profiler.stats) == ['/slow']
+    assert 'other_route_work' not in profiler.text('/slow')
+    assert sys.getprofile() is None
+
+
+async def test_profiler_cancelled_request(client, app):
+
+    profiler = extensions.profiler(app, rate=1)
+
+    @app.route('/slow')
+    async def slow(req, resp):
+        await asyncio.sleep(1)
+
+    protocol = app.factory()
+    protocol.connection_made(Transport())
+    protocol.data_received(b'GET /slow HTTP/1.1\r\n\r\n')
+    await asyncio.sleep(0)
+    protocol.task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await protocol.task
+    assert sys.getprofile() is None
+    assert list(profiler.stats) == ['/slow']
+
+
+async def test_profiler_trigger_header(client, app, tmp_path):
+
+    profiler = extensions.profiler(app, rate=0, header='X-Profile',
+                                   secret='s3cr3t', path='/_profile',
+                                   directory=tmp_path)
+
+    @app.route('/test')
+    async def get(req, resp):
+        pass
+
+    await client.get('/test')
+    await client.get('/test', headers={'X-Profile': 'invalid'})
+    assert not profiler.stats
+    await client.get('/test', headers={'X-Profile': profiler.sign('/test')})
+    assert list(profiler.stats) == ['/test']
+    assert (tmp_path / 'test.prof').exists()
+
+    resp = await client.get('/_profile')
+    assert resp.status == HTTPStatus.FORBIDDEN
+    headers = {'X-Profile': profiler.sign('/_profile')}
+    resp = await client.get('/_profile', headers=headers)
+    assert resp.status == HTTPStatus.OK
+    assert resp.body.startswith(b'/test ')
+    resp = await client.get('/_profile?route=/test', headers=headers)
+    assert b'function calls' in resp.body
+    resp = await client.get('/_profile?route=/test&format=pstats',
+                            headers=headers)
+    assert marshal.loads(resp.body) == profiler.stats['/test'].stats
+    resp = await client.get('/_profile?route=/foo', headers=headers)
+    assert resp.status == HTTPStatus.NOT_FOUND
@@ -0,0 +1,93 @@
+import os
+
+from roll.metrics import Histogram, Metrics, SharedMetrics
+
+
+def test_histogram():
+    histogram = Histogram([1, 2, 3])
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1, 1.5, 2.5, 10):
+        histogram.observe(value)
+    assert list(histogram.counts) == [2, 1, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == 15.5
+    assert histogram.quantile(0.2) == 1
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(1) == float('inf')
+
+
+def test_metrics_rows_are_preallocated():
+    metrics = Metrics([1], max_routes=2)
+    assert len(metrics.data) == 2 * metrics.width
+    assert metrics.route('/foo') == metrics.width
+    # Overflow goes to the unmatched requests row.
+    assert metrics.route('/bar') == 0
+    metrics.start(metrics.width)
+    metrics.record(metrics.width, 200, 0.5, 3, 10)
+    metrics.start(0)
+    metrics.record(0, 404, 2, 0, 9)
+    assert metrics.render().splitlines()[2:4] == [
+        'roll_requests_total{route="",status="4xx"} 1',
+        'roll_requests_total{route="/foo",status="2xx"} 1',
+    ]
+    assert 'roll_request_duration_seconds_bucket{route="",le="1"} 0' in metrics.render()
+
+
+def test_shared_metrics_are_summed_across_processes():
+    metrics = SharedMetrics([1], workers=2)
+    offset = metrics.route('/foo')
+    recorded, claimed = os.pipe(), os.pipe()
+    pid = os.fork()
+    if not pid:
+        metrics.start(offset)
+        metrics.record(offset, 200, 0.5, 3, 10)
+        os.write(recorded[1], b'1')
+        os.read(claimed[0], 1)  # Stay alive until the parent has claimed a slot.
+        os._exit(0)
+    os.read(recorded[0], 1)
+    metrics.start(offset)
+    metrics.record(offset, 201, 2, 0, 5)
+    assert list(metrics.owners) == [pid, os.getpid()]
+    os.write(claimed[1], b'1')
+    os.waitpid(pid, 0)
+    lines = metrics.render().splitlines()
+    assert 'roll_requests_total{route="/foo",status="2xx"} 2' in lines
+    assert 'roll_request_duration_seconds_bucket{route="/foo",le="1"} 1' in lines
+    assert 'roll_response_bytes_total{route="/foo"} 15' in lines
+    # Routes unknown before forking are not shared.
+    assert metrics.route('/bar') == 0
+
+
+def test_shared_metrics_claimed_again_after_fork(caplog):
+    metrics = SharedMetrics([1], workers=2)
+    offset = metrics.route('/foo')
+    metrics.start(offset)
+    # Claimed by the process which created the metrics: not shared.
+    assert 'not shared' in caplog.text
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        metrics.start(offset)
+        os.write(write, b'%d' % list(metrics.owners).index(os.getpid()))
+        os._exit(0)
+    assert os.read(read, 1) == b'1'
+    os.waitpid(pid, 0)
+    assert list(metrics.owners) == [os.getpid(), pid]
+
+
+def test_shared_metrics_slot_of_dead_worker_is_reused():
+    metrics = SharedMetrics([1], workers=1)
+    offset = metrics.route('/foo')
+    pid = os.fork()
+    if not pid:
+        metrics.start(offset)
+        metrics.start(offset)
+        metrics.record(offset, 200, 0.5, 0, 0)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    metrics.start(offset)
+    assert list(metrics.owners) == [os.getpid()]
+    lines = metrics.render().splitlines()
+    # Counters are kept, but the dead worker requests are not in flight.
+    assert 'roll_requests_total{route="/foo",status="2xx"} 1' in lines
+    assert 'roll_requests_in_flight{route="/foo"} 1' in lines
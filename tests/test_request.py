@@ -670,3 +670,44 @@ async def test_can_read_empty_body(protocol):
         b'\r\n')
     await protocol.request.load_body()
     assert protocol.request.body == b''
+
+
+@pytest.mark.parametrize('query_string', [
+    '', 'key=value', 'key=value&key=value2&other=', 'key', '&&key=1&',
+    'k%C3%A9y=v%C3%A0lue+with+spaces&key%2B=%2B', 'key=a=b', '=value',
+    'key=%ZZ', 'a;b=c',
+])
+async def test_query_parse_like_parse_qs(query_string):
+    from urllib.parse import parse_qs
+
+    from roll import Query
+
+    assert Query.parse(query_string) == parse_qs(query_string,
+                                                 keep_blank_values=True)
+
+
+async def test_query_parse_limits(app):
+
+    class MyQuery(app.Query):
+        MAX_KEYS = 2
+        MAX_LENGTH = 20
+
+    assert MyQuery.parse('a=1&b=2&a=3') == {'a': ['1', '3'], 'b': ['2']}
+    with pytest.raises(HttpError) as exc:
+        MyQuery.parse('a=1&b=2&c=3')
+    assert exc.value.status == HTTPStatus.BAD_REQUEST
+    assert exc.value.message == 'Too many query keys'
+    with pytest.raises(HttpError) as exc:
+        MyQuery.parse('a=' + 'x' * 20)
+    assert exc.value.message == 'Query string too long'
+
+
+async def test_request_cookies_are_not_shared_between_requests(protocol):
+    request = (b'GET /feeds HTTP/1.1\r\n'
+               b'Host: localhost:1707\r\n'
+               b'Cookie: key=value\r\n'
+               b'\r\n')
+    protocol.data_received(request)
+    protocol.request.cookies['key'] = 'changed'
+    protocol.data_received(request)
+    assert protocol.request.cookies['key'] == 'value'
@@ -269,3 +269,23 @@ async def test_set_redirect(client, app):
     resp = await client.get('/test')
     assert resp.status == 307
     assert resp.headers["Location"] == "https://example.org"
+
+
+async def test_write_cookies_changed_between_responses(client, app):
+
+    @app.route('/test')
+    async def get(req, resp):
+        resp.cookies.set('name', req.query.get('value'), httponly=True)
+        resp.cookies['name'].max_age = req.query.int('max_age', None)
+
+    await client.get('/test?value=foo')
+    data = client.protocol.transport.data
+    assert b'\r\nSet-Cookie: name=foo; Path=/; HttpOnly\r\n' in data
+    await client.get('/test?value=foo')
+    assert client.protocol.transport.data == data
+    await client.get('/test?value=bar')
+    data = client.protocol.transport.data
+    assert b'\r\nSet-Cookie: name=bar; Path=/; HttpOnly\r\n' in data
+    await client.get('/test?value=bar&max_age=60')
+    data = client.protocol.transport.data
+    assert b'\r\nSet-Cookie: name=bar; Max-Age=60; Path=/; HttpOnly\r\n' in data
@@ -0,0 +1,117 @@
+import gc
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from roll import Roll
+from roll.serve import load_app, memory_usage, parse_gc_threshold, preload
+
+APP = """
+import os
+from roll import Roll
+
+app = Roll()
+
+@app.route("/")
+async def pid(request, response):
+    response.body = str(os.getpid())
+"""
+
+
+@pytest.fixture
+def module(tmp_path, monkeypatch):
+    (tmp_path / "myapp.py").write_text(APP)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield "myapp"
+    sys.modules.pop("myapp", None)
+
+
+def get(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/")
+    body = conn.getresponse().read()
+    conn.close()
+    return body
+
+
+def test_load_app(module):
+    app = load_app("myapp:app")
+    assert app.routes.match("/")[0]
+    assert load_app("myapp") is app
+
+
+@pytest.mark.parametrize("options", [[], ["--reuseport"]])
+def test_serve_with_workers(module, unused_tcp_port, options):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "roll.serve", "myapp:app", "--workers", "2",
+         "--port", str(unused_tcp_port), "--quiet", *options],
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    try:
+        pids = set()
+        deadline = time.monotonic() + 10
+        while len(pids) < 2 and time.monotonic() < deadline:
+            try:
+                pids.add(get(unused_tcp_port))
+            except OSError:
+                time.sleep(0.1)
+        # Requests have been served by two distinct workers.
+        assert len(pids) == 2
+        assert str(proc.pid).encode() not in pids
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+
+
+def test_reload_does_not_lose_connections(module, unused_tcp_port):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "roll.serve", "myapp:app", "--workers", "2",
+         "--port", str(unused_tcp_port), "--quiet", "--grace", "1"],
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            assert time.monotonic() < deadline
+            try:
+                old = get(unused_tcp_port)
+                break
+            except OSError:
+                time.sleep(0.1)
+        proc.send_signal(signal.SIGHUP)
+        pids = set()
+        # Every request is served, by the old then the new workers.
+        while old in pids or not pids:
+            assert time.monotonic() < deadline
+            pids = {get(unused_tcp_port) for _ in range(20)}
+        assert str(proc.pid).encode() not in pids
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+
+
+def test_preload_freezes_objects():
+    app = Roll()
+    try:
+        preload(app)
+        assert gc.get_freeze_count() > 0
+        assert "request" in app.hooks
+    finally:
+        gc.unfreeze()
+
+
+def test_parse_gc_threshold():
+    assert parse_gc_threshold("50000,20,100") == (50000, 20, 100)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/smaps"), reason="Linux only")
+def test_memory_usage():
+    usage = memory_usage()
+    assert usage["rss"] > 0
+    assert usage["rss"] >= usage["private"]
@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+
+from roll.sse import EventSource, encode
+from roll.testing import Transport
+
+pytestmark = pytest.mark.asyncio
+
+
+def chunk(data):
+    return b'%x\r\n%b\r\n' % (len(data), data)
+
+
+async def test_encode():
+    assert encode('hello') == b'data: hello\n\n'
+    assert encode('two\nlines', event='update', id=3) == (
+        b'event: update\nid: 3\ndata: two\ndata: lines\n\n')
+    assert encode({'key': 'value'}) == b'data: {"key": "value"}\n\n'
+    assert encode(b'') == b'data: \n\n'
+    assert encode(retry=1000) == b'retry: 1000\n\n'
+    with pytest.raises(ValueError):
+        encode('data', event='bad\nevent')
+
+
+async def test_event_source_replay():
+    source = EventSource(history=3)
+    for i in range(5):
+        source.publish(i)
+    assert [e for _, e in source.history] == [
+        b'id: 3\ndata: 2\n\n', b'id: 4\ndata: 3\n\n', b'id: 5\ndata: 4\n\n']
+    assert source.replay('4') == [b'id: 5\ndata: 4\n\n']
+    assert source.replay('5') == []
+    # Unknown (too old) id: all the history.
+    assert len(source.replay('1')) == 3
+
+
+async def test_sse_response(client, app):
+    source = EventSource(retry=2000)
+    source.publish('first')
+    source.publish('second')
+
+    @app.route('/events')
+    async def events(request, response):
+        response.sse = source
+        asyncio.get_event_loop().call_soon(source.publish, 'third', 'update')
+        asyncio.get_event_loop().call_soon(source.close)
+
+    resp = await client.get('/events', headers={'Last-Event-ID': '1'})
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+    assert resp.headers['Cache-Control'] == 'no-cache'
+    data = client.protocol.transport.data
+    assert data.endswith(
+        b'\r\n\r\n'
+        + chunk(b'retry: 2000\n\nid: 2\ndata: second\n\n')
+        + chunk(b'event: update\nid: 3\ndata: third\n\n')
+        + b'0\r\n\r\n')
+    assert not source.streams
+
+
+async def test_sse_from_async_generator(client, app):
+
+    async def events():
+        yield encode('one')
+        yield encode('two')
+
+    @app.route('/events')
+    async def handler(request, response):
+        response.sse = events()
+
+    resp = await client.get('/events')
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+    assert client.protocol.transport.data.endswith(
+        b'\r\n\r\n' + chunk(b'data: one\n\n') + chunk(b'data: two\n\n')
+        + b'0\r\n\r\n')
+
+
+async def test_sse_stops_when_client_is_gone(client, app):
+    source = EventSource()
+
+    @app.route('/events')
+    async def events(request, response):
+        response.sse = source
+        client.protocol.transport.close()
+        asyncio.get_event_loop().call_soon(source.publish, 'lost')
+
+    await client.get('/events')
+    assert not source.streams
+    assert source._timer is None
+
+
+async def test_sse_ends_slow_consumers(client, app):
+    source = EventSource(max_buffer=10)
+
+    @app.route('/events')
+    async def events(request, response):
+        response.sse = source
+        client.protocol.transport.get_write_buffer_size = lambda: 11
+        asyncio.get_event_loop().call_soon(source.publish, 'too slow')
+
+    await client.get('/events')
+    assert not source.streams
+    assert source.dropped == 1
+    assert client.protocol.transport.data.endswith(b'\r\n\r\n0\r\n\r\n')
+
+
+async def test_sse_head_does_not_subscribe(client, app):
+    source = EventSource()
+
+    @app.route('/events', methods=['GET', 'HEAD'])
+    async def events(request, response):
+        response.sse = source
+
+    resp = await client.head('/events')
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+    assert not source.streams
+    assert source._timer is None
+
+
+async def test_sse_view_error_does_not_subscribe(client, app):
+    source = EventSource()
+
+    @app.route('/events')
+    async def events(request, response):
+        response.sse = source
+        raise ValueError('Oops')
+
+    resp = await client.get('/events')
+    assert resp.status == 500
+    assert not source.streams
+
+
+async def test_sse_pending_limit():
+    source = EventSource(max_pending=3)
+    stream = source.stream(Transport())
+    assert not source.streams
+    assert stream.__aiter__() is stream
+    assert source.streams == {stream}
+    for i in range(4):
+        source.publish(i)
+    # Ended once full, the pending events are still written.
+    assert stream.closed
+    assert source.dropped == 1
+    assert not source.streams
+    assert await stream.__anext__() == (
+        b'id: 1\ndata: 0\n\nid: 2\ndata: 1\n\nid: 3\ndata: 2\n\n')
+    with pytest.raises(StopAsyncIteration):
+        await stream.__anext__()
+
+
+async def test_sse_fan_out_and_heartbeat(app, liveclient):
+    source = EventSource(heartbeat=0.05)
+
+    @app.route('/events')
+    async def events(request, response):
+        response.sse = source
+
+    request = b'GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n'
+    connections = []
+    for _ in range(3):
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', liveclient.port)
+        writer.write(request)
+        await reader.readuntil(b'\r\n\r\n')
+        connections.append((reader, writer))
+    while len(source.streams) < 3:
+        await asyncio.sleep(0.01)
+
+    source.publish('hello')
+    for reader, _ in connections:
+        assert await reader.readuntil(b'\n\n\r\n') == chunk(
+            b'id: 1\ndata: hello\n\n')
+        assert await reader.readuntil(b'\n\n\r\n') == chunk(b':\n\n')
+
+    for _, writer in connections:
+        writer.close()
+    while source.streams:
+        await asyncio.sleep(0.01)
+    assert source._timer is None
@@ -1,10 +1,23 @@
+import asyncio
 from http import HTTPStatus
 
 import pytest
 
+from roll import ConcurrencyLimit
+from roll.sse import EventSource
+from roll.testing import Transport
+
 pytestmark = pytest.mark.asyncio
 
 
+def send(app, path):
+    # Send a request without waiting for the response.
+    protocol = app.factory()
+    protocol.connection_made(Transport())
+    protocol.data_received(b"GET %b HTTP/1.1\r\n\r\n" % path.encode())
+    return protocol
+
+
 async def test_simple_get_request(client, app):
 
     @app.route('/test')
@@ -132,3 +145,333 @@ async def test_route_with_different_signatures_on_same_handler(client, app):
 
     assert (await client.get("/test/")).body == b"default"
     assert (await client.get("/test/other")).body == b"other"
+
+
+async def test_max_concurrency_queues_requests(client, app):
+    event = asyncio.Event()
+
+    @app.route("/test", max_concurrency=1)
+    async def get(req, resp):
+        await event.wait()
+        resp.body = "done"
+
+    first = send(app, "/test")
+    second = send(app, "/test")
+    await asyncio.sleep(0)
+    limit = app.limits["/test"]
+    assert limit.active == 1
+    assert limit.waiting == 1
+    event.set()
+    await first.task
+    await second.task
+    assert second.response.status == HTTPStatus.OK
+    assert second.response.body == b"done"
+    assert limit.active == 0
+    assert limit.waiting == 0
+    assert limit.waited == 1
+
+
+async def test_queue_size_rejects_requests(client, app):
+    event = asyncio.Event()
+
+    @app.route("/test", max_concurrency=1, queue_size=1)
+    async def get(req, resp):
+        await event.wait()
+
+    first = send(app, "/test")
+    second = send(app, "/test")
+    await asyncio.sleep(0)
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.SERVICE_UNAVAILABLE
+    assert resp.body == b"Too many queued requests"
+    assert app.limits["/test"].rejected == 1
+    event.set()
+    await first.task
+    await second.task
+
+
+async def test_queue_size_is_not_websocket_max_queue(app):
+
+    @app.route("/ws", protocol="websocket", max_concurrency=2, max_queue=16)
+    async def handler(request, ws):
+        pass
+
+    assert app.limits["/ws"].queue_size is None
+
+
+async def test_queue_timeout(client, app):
+    event = asyncio.Event()
+
+    @app.route("/test", max_concurrency=1, queue_timeout=0.01)
+    async def get(req, resp):
+        await event.wait()
+
+    first = send(app, "/test")
+    await asyncio.sleep(0)
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.SERVICE_UNAVAILABLE
+    assert resp.body == b"Timed out in queue"
+    limit = app.limits["/test"]
+    assert limit.timeouts == 1
+    assert limit.waiting == 0
+    event.set()
+    await first.task
+    assert limit.active == 0
+
+
+async def test_deadline_while_queued(client, app):
+    event = asyncio.Event()
+
+    @app.route("/test", max_concurrency=1, queue_timeout=5, timeout=0.01)
+    async def get(req, resp):
+        await event.wait()
+
+    first = send(app, "/test")
+    await asyncio.sleep(0)
+    resp = await client.get("/test")
+    # The deadline expired first: not a queue timeout.
+    assert resp.status == HTTPStatus.GATEWAY_TIMEOUT
+    limit = app.limits["/test"]
+    assert limit.timeouts == 0
+    assert limit.waiting == 0
+    event.set()
+    await first.task
+    assert first.response.status == HTTPStatus.GATEWAY_TIMEOUT
+    assert limit.active == 0
+
+
+async def test_shared_concurrency_limit_with_priorities(client, app):
+    event = asyncio.Event()
+    calls = []
+    limit = ConcurrencyLimit(1)
+
+    @app.route("/batch", max_concurrency=limit, priority=10)
+    async def batch(req, resp):
+        calls.append("batch")
+        await event.wait()
+
+    @app.route("/interactive", max_concurrency=limit)
+    async def interactive(req, resp):
+        calls.append("interactive")
+        await event.wait()
+
+    first = send(app, "/batch")
+    await asyncio.sleep(0)
+    second = send(app, "/batch")
+    third = send(app, "/interactive")
+    await asyncio.sleep(0)
+    assert limit.waiting == 2
+    event.set()
+    await asyncio.gather(first.task, second.task, third.task)
+    assert calls == ["batch", "interactive", "batch"]
+    assert app.limits["/batch"] is app.limits["/interactive"]
+
+
+async def test_route_timeout(client, app):
+
+    @app.route("/test", timeout=0.01)
+    async def get(req, resp):
+        assert 0 < req.remaining <= 0.01
+        await asyncio.sleep(1)
+
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.GATEWAY_TIMEOUT
+    assert resp.body == b"Gateway Timeout"
+
+
+async def test_timeout_runs_view_in_request_task(client, app):
+    app.TIMEOUT = 5
+    tasks = []
+
+    @app.route("/test")
+    async def get(req, resp):
+        tasks.append(asyncio.current_task())
+
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.OK
+    assert tasks == [client.protocol.task]
+
+
+async def test_timeout_lets_other_cancellations_through(client, app):
+    app.TIMEOUT = 5
+
+    @app.route("/test")
+    async def get(req, resp):
+        asyncio.current_task().cancel()
+        await asyncio.sleep(1)
+
+    with pytest.raises(asyncio.CancelledError):
+        await client.get("/test")
+
+
+async def test_app_timeout_can_be_overridden_per_route(client, app):
+    app.TIMEOUT = 0.01
+
+    @app.route("/test", timeout=None)
+    async def get(req, resp):
+        assert req.deadline is None
+        await asyncio.sleep(0.02)
+        resp.body = "done"
+
+    @app.route("/other")
+    async def other(req, resp):
+        await asyncio.sleep(1)
+
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.OK
+    resp = await client.get("/other")
+    assert resp.status == HTTPStatus.GATEWAY_TIMEOUT
+
+
+async def test_timeout_goes_through_error_hook(client, app):
+    app.TIMEOUT = 0.01
+    timeouts = []
+
+    @app.listen("error")
+    async def on_error(request, response, error):
+        if error.status == HTTPStatus.GATEWAY_TIMEOUT:
+            timeouts.append(request.path)
+            assert isinstance(error.__context__, asyncio.TimeoutError)
+
+    @app.route("/test")
+    async def get(req, resp):
+        await asyncio.sleep(1)
+
+    await client.get("/test")
+    assert timeouts == ["/test"]
+
+
+async def test_deadline_from_header(client, app):
+    app.TIMEOUT = 10
+    app.DEADLINE_HEADER = "X-Request-Timeout"
+
+    @app.route("/test")
+    async def get(req, resp):
+        resp.body = str(req.remaining <= 2)
+
+    resp = await client.get("/test")
+    assert resp.body == b"False"
+    resp = await client.get("/test", headers={"X-Request-Timeout": "2"})
+    assert resp.body == b"True"
+    # Header can only shrink the budget.
+    resp = await client.get("/test", headers={"X-Request-Timeout": "20"})
+    assert resp.body == b"False"
+    resp = await client.get("/test", headers={"X-Request-Timeout": "foo"})
+    assert resp.status == HTTPStatus.BAD_REQUEST
+
+
+async def test_no_timeout_by_default(client, app):
+
+    @app.route("/test")
+    async def get(req, resp):
+        assert req.deadline is None
+        assert req.remaining is None
+
+    resp = await client.get("/test")
+    assert resp.status == HTTPStatus.OK
+
+
+async def test_drain_waits_for_requests_in_flight(client, app):
+    event = asyncio.Event()
+
+    @app.route("/test")
+    async def get(req, resp):
+        await event.wait()
+        resp.body = "done"
+
+    idle = send(app, "/test")
+    event.set()
+    await idle.task
+    assert not idle.transport.is_closing()
+    event.clear()
+    busy = send(app, "/test")
+    drain = asyncio.ensure_future(app.drain(1))
+    await asyncio.sleep(0)
+    assert idle.transport.is_closing()
+    assert not busy.transport.is_closing()
+    event.set()
+    assert await drain == (1, 0)
+    assert busy.response.status == HTTPStatus.OK
+    assert busy.response.headers["Connection"] == "close"
+    assert busy.transport.is_closing()
+
+
+async def test_drain_ends_streams(client, app):
+    source = EventSource()
+
+    @app.route("/events")
+    async def events(req, resp):
+        resp.sse = source
+
+    stream = send(app, "/events")
+    await asyncio.sleep(0)
+    assert source.streams
+    assert await asyncio.wait_for(app.drain(1), 0.5) == (1, 0)
+    assert stream.transport.data.endswith(b"0\r\n\r\n")
+    assert stream.transport.is_closing()
+    assert not source.streams
+
+
+async def test_drain_waits_for_chunked_bodies(client, app):
+    event = asyncio.Event()
+
+    async def parts():
+        for i in range(5):
+            yield f"part{i}"
+            if i == 2:
+                await event.wait()
+
+    @app.route("/test")
+    async def get(req, resp):
+        resp.body = parts()
+
+    finished = send(app, "/test")
+    await asyncio.sleep(0)
+    drain = asyncio.ensure_future(app.drain(1))
+    await asyncio.sleep(0.01)
+    assert not finished.transport.is_closing()
+    event.set()
+    assert await drain == (1, 0)
+    assert finished.transport.data.endswith(
+        b"5\r\npart3\r\n5\r\npart4\r\n0\r\n\r\n")
+    assert finished.transport.is_closing()
+
+    # Cut when too slow: not ended by the last chunk.
+    app.closing = False
+    event.clear()
+    cut = send(app, "/test")
+    await asyncio.sleep(0)
+    assert await app.drain(0.01) == (0, 1)
+    assert cut.transport.data.endswith(b"5\r\npart2\r\n")
+    assert cut.transport.is_closing()
+
+
+async def test_drain_waits_for_partial_requests(client, app):
+
+    @app.route("/test")
+    async def get(req, resp):
+        resp.body = "done"
+
+    partial = app.factory()
+    partial.connection_made(Transport())
+    partial.data_received(b"GET /test HTTP/1.1\r\nHost: ")
+    drain = asyncio.ensure_future(app.drain(1))
+    await asyncio.sleep(0.01)
+    assert not partial.transport.is_closing()
+    partial.data_received(b"localhost\r\n\r\n")
+    assert await drain == (1, 0)
+    assert partial.response.body == b"done"
+    assert partial.transport.is_closing()
+
+
+async def test_drain_kills_requests_after_timeout(client, app):
+
+    @app.route("/test")
+    async def get(req, resp):
+        await asyncio.sleep(1)
+
+    slow = send(app, "/test")
+    assert await app.drain(0.01) == (0, 1)
+    assert slow.transport.is_closing()
+    with pytest.raises(asyncio.CancelledError):
+        await slow.task
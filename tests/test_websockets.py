@@ -2,7 +2,10 @@ import pytest
 import asyncio
 import websockets
 from http import HTTPStatus
-from roll.extensions import websockets_store
+from roll.extensions import websockets_keepalive, websockets_store
+from roll.testing import Transport
+from websockets.exceptions import ConnectionClosed
+from websockets.protocol import State
 
 
 @pytest.mark.asyncio
@@ -146,3 +149,231 @@ async def test_websocket_route_with_subprotocols(liveclient):
         'Sec-WebSocket-Version': '13'})
     assert response.status == HTTPStatus.SWITCHING_PROTOCOLS
     assert results == ['bar', 'bar', None, None]
+
+
+@pytest.mark.asyncio
+async def test_websocket_broadcast_to_groups(app, liveclient):
+
+    store = websockets_store(app)
+    assert app['websockets'] is store
+
+    @app.route('/room/foo', protocol="websocket")
+    @app.route('/room/bar', protocol="websocket")
+    async def room(request, ws):
+        name = request.path.split('/')[-1]
+        store.join(ws, name)
+        async for message in ws:
+            store.broadcast(message, group=name, exclude=ws)
+
+    foo1 = await websockets.connect(liveclient.wsl + '/room/foo')
+    foo2 = await websockets.connect(liveclient.wsl + '/room/foo')
+    bar = await websockets.connect(liveclient.wsl + '/room/bar')
+    await asyncio.sleep(0.01)
+    assert len(store) == 3
+    assert len(store.groups['foo']) == 2
+
+    await foo1.send('hello foo')
+    assert await foo2.recv() == 'hello foo'
+    await bar.send(b'hello bar')  # Alone in its room.
+    assert store.broadcast(b'\x00binary') == 3
+    for ws in (foo1, foo2, bar):
+        assert await ws.recv() == b'\x00binary'
+
+    await foo2.close()
+    await bar.close()
+    await asyncio.sleep(0.01)
+    assert len(store) == 1
+    assert list(store.groups) == ['foo']
+    assert store.broadcast('bye', group='bar') == 0
+    await foo1.close()
+
+
+@pytest.mark.asyncio
+async def test_websocket_broadcast_slow_consumers(app, liveclient):
+
+    store = websockets_store(app, max_buffer=0, policy='drop')
+
+    @app.route('/ws', protocol="websocket")
+    async def handler(request, ws):
+        await ws.wait_closed()
+
+    ws = await websockets.connect(liveclient.wsl + '/ws')
+    await asyncio.sleep(0.01)
+    server_ws = next(iter(store))
+    server_ws.transport.get_write_buffer_size = lambda: 1
+    assert store.broadcast('foo') == 0
+    assert store.dropped == 1
+    store.policy = 'close'
+    assert store.broadcast('foo') == 0
+    assert store.closed == 1
+    await ws.wait_closed()
+    assert ws.close_code == 1008
+
+
+@pytest.mark.asyncio
+async def test_websocket_broadcast_drops_closed_sockets(app):
+    class Compressed:
+        state = State.OPEN
+        extensions = ['permessage-deflate']
+        _fragmented_message_waiter = None
+        transport = Transport()
+
+        def __init__(self, closed):
+            self.closed = closed
+            self.sent = []
+
+        async def send(self, message):
+            if self.closed:
+                raise ConnectionClosed(1006, '')
+            self.sent.append(message)
+
+    store = websockets_store(app)
+    alive, gone = Compressed(False), Compressed(True)
+    store.update((alive, gone))
+    store.join(gone, 'room')
+    assert store.broadcast('hello') == 2
+    await asyncio.gather(*store.tasks)
+    assert not store.tasks
+    assert alive.sent == ['hello']
+    assert store == {alive}
+    assert not store.groups
+
+
+def test_websockets_store_membership(app):
+    store = websockets_store(app)
+    store.update(('ws1', 'ws2'))
+    store.join('ws1', 'room')
+    store.join('ws2', 'room', 'other')
+    store.remove('ws1')
+    assert store.groups == {'room': {'ws2'}, 'other': {'ws2'}}
+    store.clear()
+    assert not store.groups and not store.memberships
+
+
+@pytest.mark.asyncio
+async def test_websocket_compression(app, liveclient):
+    server = []
+
+    @app.route('/ws', protocol="websocket",
+               compression={'server_max_window_bits': 10, 'min_size': 100})
+    async def handler(request, ws):
+        server.append(ws)
+        async for message in ws:
+            if message == 'fragments':
+                message = ['foo', 'x' * 1000]
+            await ws.send(message)
+
+    @app.route('/raw', protocol="websocket")
+    async def raw(request, ws):
+        await ws.send('foo')
+
+    websocket = await websockets.connect(liveclient.wsl + '/ws')
+    assert len(websocket.extensions) == 1
+    assert websocket.extensions[0].remote_max_window_bits == 10
+    await websocket.send('x' * 1000)
+    assert await websocket.recv() == 'x' * 1000
+    extension = server[0].extensions[0]
+    small = websockets.framing.Frame(True, websockets.framing.OP_TEXT, b'foo')
+    assert extension.encode(small) is small
+    big = small._replace(data=b'x' * 1000)
+    assert extension.encode(big).rsv1
+    # Fragmented message: continuation frames follow the first one.
+    first = small._replace(fin=False)
+    assert extension.encode(first) is first
+    last = big._replace(opcode=websockets.framing.OP_CONT)
+    assert extension.encode(last) is last
+    assert extension.encode(big._replace(fin=False)).rsv1
+    assert not extension.encode(last).rsv1
+    await websocket.send('fragments')
+    assert await websocket.recv() == 'foo' + 'x' * 1000
+    await websocket.close()
+
+    # Client not asking for compression.
+    websocket = await websockets.connect(liveclient.wsl + '/ws',
+                                         compression=None)
+    assert websocket.extensions == []
+    await websocket.close()
+
+    # Compression not enabled.
+    websocket = await websockets.connect(liveclient.wsl + '/raw')
+    assert websocket.extensions == []
+    assert await websocket.recv() == 'foo'
+
+
+@pytest.mark.asyncio
+async def test_websocket_shared_keepalive(app, liveclient):
+
+    keepalive = websockets_keepalive(app, interval=0.02, timeout=0.02)
+
+    @app.route('/ws', protocol="websocket")
+    async def handler(request, ws):
+        assert ws.ping_interval is None
+        await ws.wait_closed()
+
+    # Answering client.
+    websocket = await websockets.connect(liveclient.wsl + '/ws')
+    # Client not answering pings.
+    reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                   liveclient.port)
+    writer.write(b'GET /ws HTTP/1.1\r\n'
+                 b'Host: localhost\r\n'
+                 b'Upgrade: websocket\r\n'
+                 b'Connection: upgrade\r\n'
+                 b'Sec-WebSocket-Key: hojIvDoHedBucveephosh8==\r\n'
+                 b'Sec-WebSocket-Version: 13\r\n\r\n')
+    assert (await reader.readline()).startswith(b'HTTP/1.1 101')
+    await asyncio.sleep(0.2)
+    assert keepalive.pings > 2
+    assert keepalive.closed == 1
+    assert sum(ws.open for ws in keepalive.connections) == 1
+    assert websocket.open
+    await websocket.close()
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_websocket_route_limits(app, liveclient):
+
+    @app.route('/small', protocol="websocket", max_size=16, max_queue=2)
+    async def small(request, ws):
+        assert ws.max_size == 16
+        assert ws.max_queue == 2
+        assert ws.read_limit == app.WebsocketProtocol.READ_LIMIT
+        await ws.send(await ws.recv())
+        await ws.recv()
+
+    websocket = await websockets.connect(liveclient.wsl + '/small')
+    try:
+        await websocket.send('small')
+        assert await websocket.recv() == 'small'
+        await websocket.send('x' * 17)
+        with pytest.raises(websockets.ConnectionClosed) as info:
+            await websocket.recv()
+        assert info.value.code == 1009
+    finally:
+        await websocket.close()
+
+    payload, _ = app.routes.match('/small')
+    assert app.WebsocketProtocol.max_memory(payload) == (
+        16 * 3 + 2**16 + 2**16)
+    assert app.WebsocketProtocol.max_memory() == (
+        2**20 * 65 + 2 * 2**16)
+    assert app.WebsocketProtocol.max_memory({'max_queue': None}) is None
+
+
+@pytest.mark.asyncio
+async def test_websocket_closed_on_drain(app, liveclient):
+
+    @app.route('/ws', protocol="websocket")
+    async def handler(request, ws):
+        async for message in ws:
+            pass
+
+    websocket = await websockets.connect(liveclient.wsl + '/ws')
+    while not app.connections:
+        await asyncio.sleep(0.01)
+    drained = await asyncio.wait_for(app.drain(5), 2)
+    assert drained == (1, 0)
+    await websocket.wait_closed()
+    assert websocket.close_code == 1001
+    app.closing = False
@@ -0,0 +1,114 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+from gunicorn.config import Config
+
+from roll import Roll
+from roll import worker as roll_worker
+from roll.worker import DEFAULTS, Worker
+
+APP = """
+import gc
+from roll import Roll
+
+app = Roll()
+
+@app.route("/")
+async def threshold(request, response):
+    response.json = gc.get_threshold()
+"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        super().__init__("localhost", timeout=5)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def get(conn):
+    conn.request("GET", "/")
+    data = json.loads(conn.getresponse().read())
+    conn.close()
+    return data
+
+
+def test_settings_command_line():
+    out = subprocess.run(
+        [sys.executable, "-m", "roll.worker", "--help"],
+        stdout=subprocess.PIPE, check=True).stdout
+    for flag in (b"--tcp-defer-accept", b"--tcp-fastopen", b"--gc-threshold"):
+        assert flag in out
+
+
+@pytest.mark.skipif(not hasattr(socket, "TCP_FASTOPEN"),
+                    reason="TCP_FASTOPEN not available")
+def test_tune_tcp_socket():
+    settings = {**DEFAULTS, "tcp_defer_accept": 5, "tcp_fastopen": 16}
+    worker = SimpleNamespace(setting=settings.get)
+    with socket.socket() as sock:
+        Worker.tune(worker, sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN) == 16
+        if hasattr(socket, "TCP_DEFER_ACCEPT"):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT)
+    with socket.socket() as sock:
+        Worker.tune(SimpleNamespace(setting=DEFAULTS.get), sock)
+        assert not sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN)
+
+
+def test_preload_once_before_forking(monkeypatch):
+    preloaded = []
+    monkeypatch.setattr(roll_worker, "preload", preloaded.append)
+    monkeypatch.setattr(Worker, "preloaded", False)
+    cfg = Config()
+    cfg.set("preload_app", True)
+    app = Roll()
+    wsgi = SimpleNamespace(wsgi=lambda: app)
+    # Instantiated by the arbiter for each worker to fork.
+    for _ in range(3):
+        Worker(0, os.getpid(), [], wsgi, 30, cfg, None).tmp.close()
+    assert preloaded == [app]
+
+
+def test_worker_serves_all_sockets(tmp_path, monkeypatch, unused_tcp_port):
+    (tmp_path / "workerapp.py").write_text(APP)
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "app.sock")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "roll.worker", "workerapp:app",
+         "--bind", f"unix:{path}", "--bind", f"127.0.0.1:{unused_tcp_port}",
+         "--gc-threshold", "50000,20,100", "--tcp-fastopen", "16"],
+        env={**os.environ,
+             "PYTHONPATH": os.pathsep.join([os.getcwd(), *sys.path])},
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            assert time.monotonic() < deadline
+            try:
+                over_tcp = get(
+                    http.client.HTTPConnection(
+                        "127.0.0.1", unused_tcp_port, timeout=5))
+                break
+            except OSError:
+                time.sleep(0.1)
+        # Same worker, on both sockets, with its GC thresholds set.
+        assert over_tcp == [50000, 20, 100]
+        assert get(UnixHTTPConnection(path)) == [50000, 20, 100]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0